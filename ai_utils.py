@@ -1,22 +1,322 @@
 # ai_utils.py
+import abc
 import os
+import re
+import json
+import hashlib
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
 import numpy as np
-from openai import OpenAI
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# формат хранения в Listing.embedding_blob: float32 или float16 (вдвое меньше)
+EMBED_DTYPE = os.getenv("EMBED_DTYPE", "float32")
+
+
+# ----------------------------
+# EMBEDDING BACKENDS
+# ----------------------------
+# EMBED_BACKEND=openai (по умолчанию) | hashing | replay
+# hashing и replay работают без сети — для тестов и нагрузочных прогонов.
+
+class EmbeddingBackend(abc.ABC):
+    model = None
+
+    @abc.abstractmethod
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        """Эмбеддинги texts в том же порядке."""
+
+
+class OpenAIBackend(EmbeddingBackend):
+    def __init__(self, model: str):
+        self.model = model
+        self._client = None
+
+    @property
+    def client(self):
+        # клиент создаётся при первом запросе, а не при импорте ai_utils
+        if self._client is None:
+            from openai import OpenAI
+            self._client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        return self._client
+
+    def embed(self, texts):
+        resp = self.client.embeddings.create(model=self.model, input=texts)
+        return [item.embedding for item in sorted(resp.data, key=lambda item: item.index)]
+
+
+class HashingBackend(EmbeddingBackend):
+    """
+    Детерминированный офлайн-эмбеддер: слова и символьные триграммы
+    хэшируются (blake2b, не зависит от PYTHONHASHSEED) в dim знаковых
+    корзин — это случайная проекция мешка признаков. Похожие тексты дают
+    похожие векторы, так что поиск можно гонять без API.
+    """
+
+    def __init__(self, dim: int = 3072):
+        self.dim = dim
+        self.model = f"hashing-v1-{dim}"
+
+    def _features(self, text):
+        words = re.findall(r"\w+", text.casefold())
+        for word in words:
+            yield word, 1.0
+            padded = f"#{word}#"
+            for i in range(len(padded) - 2):
+                yield padded[i:i + 3], 0.5
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, weight in self._features(text):
+                h = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), "little")
+                vectors[row, h % self.dim] += weight if (h >> 63) else -weight
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return (vectors / np.maximum(norms, 1e-9)).tolist()
+
+
+class ReplayBackend(EmbeddingBackend):
+    """
+    Отдаёт заранее записанные эмбеддинги из fixture-файла
+    {"model": ..., "embeddings": {text: vector}}. С record_from новые тексты
+    считаются этим бэкендом и дописываются в файл (так фикстура и записывается).
+    """
+
+    def __init__(self, path: str, record_from: EmbeddingBackend = None):
+        self.path = path
+        self.record_from = record_from
+        self._lock = threading.Lock()
+        self._embeddings = {}
+        self.model = record_from.model if record_from else None
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            self.model = data.get("model") or self.model
+            self._embeddings = data.get("embeddings", {})
+
+    def embed(self, texts):
+        missing = [text for text in dict.fromkeys(texts) if text not in self._embeddings]
+        if missing:
+            if not self.record_from:
+                raise KeyError(f"No recorded embedding for {missing[0]!r} in {self.path}")
+            vectors = self.record_from.embed(missing)
+            with self._lock:
+                self._embeddings.update(zip(missing, vectors))
+                with open(self.path, "w", encoding="utf-8") as f:
+                    json.dump({"model": self.model, "embeddings": self._embeddings}, f)
+        return [self._embeddings[text] for text in texts]
+
+
+def make_backend(name: str = None) -> EmbeddingBackend:
+    name = name or os.getenv("EMBED_BACKEND", "openai")
+    if name == "openai":
+        return OpenAIBackend(os.getenv("EMBED_MODEL", "text-embedding-3-large"))
+    if name == "hashing":
+        return HashingBackend(int(os.getenv("EMBED_DIM", 3072)))
+    if name == "replay":
+        record = os.getenv("EMBED_RECORD_BACKEND")
+        return ReplayBackend(
+            os.getenv("EMBED_FIXTURE_PATH", "embeddings_fixture.json"),
+            record_from=make_backend(record) if record else None
+        )
+    raise ValueError(f"Unknown EMBED_BACKEND: {name}")
+
+
+backend = make_backend()
+EMBED_MODEL = backend.model
 
-EMBED_MODEL = "text-embedding-3-large"  # можно и text-embedding-3-small
 
 def get_embedding(text: str) -> list[float]:
     """
     Возвращает эмбеддинг текста как список float.
     """
-    text = text.replace("\n", " ")
-    resp = client.embeddings.create(
-        model=EMBED_MODEL,
-        input=text
-    )
-    return resp.data[0].embedding
+    return get_embeddings([text])[0]
+
+def get_embeddings(texts: list[str]) -> list[list[float]]:
+    """
+    Эмбеддинги для нескольких текстов одним запросом (API принимает список),
+    в том же порядке, что и texts.
+    """
+    return backend.embed([text.replace("\n", " ") for text in texts])
+
+def embedding_text(title: str, city: str, description: str) -> str:
+    """
+    Текст объявления, по которому считается эмбеддинг.
+    """
+    return f"{title}. {city}. {description or ''}"
+
+def embedding_text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+# ----------------------------
+# QUERY EMBEDDINGS (AI search)
+# ----------------------------
+# Поисковые запросы сильно повторяются ("wg berlin", "1 zimmer münchen"), поэтому:
+# - кэш по нормализованному тексту: LRU в памяти + SQLite-файл (EMBED_CACHE_PATH);
+# - одинаковые одновременные запросы ждут один и тот же in-flight вызов;
+# - разные запросы, пришедшие в пределах EMBED_BATCH_WINDOW_MS, уходят одним
+#   multi-input запросом к embeddings API.
+
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", 2048))
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH")
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", 5))
+EMBED_BATCH_MAX = 64
+
+
+def normalize_query(text: str) -> str:
+    return " ".join(text.casefold().split())
+
+
+class QueryEmbeddingCache:
+    def __init__(self, maxsize: int, path: str = None):
+        self.maxsize = maxsize
+        self.path = path
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        if path:
+            with sqlite3.connect(path, timeout=1) as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS query_embedding "
+                    "(key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+                )
+
+    def get(self, key: str):
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                return vector
+
+        if self.path:
+            try:
+                with sqlite3.connect(self.path, timeout=1) as conn:
+                    row = conn.execute(
+                        "SELECT vector FROM query_embedding WHERE key = ?", (key,)
+                    ).fetchone()
+            except sqlite3.Error:
+                row = None
+            if row:
+                vector = np.frombuffer(row[0], dtype="<f4").tolist()
+                self._remember(key, vector)
+                return vector
+        return None
+
+    def set(self, key: str, vector: list[float]):
+        self._remember(key, vector)
+        if self.path:
+            try:
+                with sqlite3.connect(self.path, timeout=1) as conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO query_embedding (key, vector) VALUES (?, ?)",
+                        (key, np.asarray(vector, dtype="<f4").tobytes())
+                    )
+            except sqlite3.Error:
+                pass
+
+    def _remember(self, key, vector):
+        with self._lock:
+            self._memory[key] = vector
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.maxsize:
+                self._memory.popitem(last=False)
+
+
+class EmbeddingBatcher:
+    """
+    Фоновый поток, который собирает тексты в пределах window_ms
+    (но не больше max_batch) и отправляет их одним вызовом get_embeddings.
+    on_result(text, vector) вызывается до того, как ожидающие получат результат.
+    """
+
+    def __init__(self, window_ms: float, max_batch: int, on_result=None):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.on_result = on_result
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, text: str) -> Future:
+        future = Future()
+        self._queue.put((text, future))
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name="embedding-batcher", daemon=True
+                    )
+                    self._thread.start()
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            try:
+                vectors = get_embeddings([text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (text, future), vector in zip(batch, vectors):
+                if self.on_result:
+                    self.on_result(text, vector)
+                future.set_result(vector)
+
+
+def _query_cache_key(normalized: str) -> str:
+    return f"{EMBED_MODEL}:{normalized}"
+
+
+query_cache = QueryEmbeddingCache(EMBED_CACHE_SIZE, EMBED_CACHE_PATH)
+_batcher = EmbeddingBatcher(
+    EMBED_BATCH_WINDOW_MS, EMBED_BATCH_MAX,
+    on_result=lambda text, vector: query_cache.set(_query_cache_key(text), vector)
+)
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def get_query_embedding(text: str, timeout: float = 30) -> list[float]:
+    """
+    Эмбеддинг поискового запроса через кэш, с объединением одинаковых
+    одновременных запросов и micro-batching разных.
+    """
+    normalized = normalize_query(text)
+    key = _query_cache_key(normalized)
+
+    vector = query_cache.get(key)
+    if vector is not None:
+        return vector
+
+    with _inflight_lock:
+        future = _inflight.get(key)
+        if future is None:
+            future = _batcher.submit(normalized)
+            _inflight[key] = future
+
+            def _done(_, key=key):
+                with _inflight_lock:
+                    _inflight.pop(key, None)
+
+            future.add_done_callback(_done)
+
+    return future.result(timeout=timeout)
+
 
 def cosine_sim(a: list[float], b: list[float]) -> float:
     """
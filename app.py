@@ -1,13 +1,12 @@
 from flask import Flask, render_template, request, redirect,url_for, session, jsonify, abort
 from werkzeug.security import check_password_hash, generate_password_hash
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
 from datetime import timedelta
 from datetime import datetime
 from sqlalchemy import func
 import re
 import os
-import shutil
-import hashlib
 
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4
@@ -21,12 +20,29 @@ load_dotenv()
 from flask_babel import Babel, _, get_locale
 
 from models import (
-    db, User, Listing, ListingImage, ReviewListing,
+    db, User, Listing, ListingImage, ReviewListing, ListingDuplicate,
     MessageThread, Message,
     Deal, DealDocument, DealAudit,
     DealContract, DealContractSigned
 )
-#from ai_utils import get_embedding, cosine_sim
+from search_utils import (
+    parse_listing_filters, parse_sort, search_listings_page, front_page_listings,
+    listing_facets, load_listings,
+    listing_cache, ensure_catalogue_state, bump_catalogue_version,
+    city_index, ensure_fulltext_index, index_listing_text, unindex_listing
+)
+from vector_index import listing_index, ensure_listing_index, listing_attributes
+from ai_utils import get_query_embedding, EMBED_MODEL
+from embedding_queue import embedding_queue
+from similar_listings import similar_listings, remove_similar
+from image_variants import image_variants, is_image
+from blob_store import blob_store, BLOB_DIR
+from upload_sink import save_upload, copy_file, MAX_UPLOAD_BYTES
+from image_metadata import strip_metadata
+from file_sweeper import file_sweeper, bury_dir, restore_dirs
+from duplicates import (
+    find_duplicates, index_listing_shingles, unindex_listing_shingles, record_duplicate
+)
 
 app = Flask(__name__)
 
@@ -59,6 +75,25 @@ app.config["UPLOAD_FOLDER"] = os.getenv(
     "UPLOAD_FOLDER",
     os.path.join("static", "uploads")
 )
+# лимит на всё тело запроса: werkzeug отвечает 413 ещё при чтении, не буферизуя лишнее.
+# Лимит на один файл (MAX_UPLOAD_MB) проверяет upload_sink; по умолчанию запрос
+# вмещает MAX_LISTING_PHOTOS фото предельного размера и поля формы
+MAX_LISTING_PHOTOS = int(os.getenv("MAX_LISTING_PHOTOS", 20))
+app.config["MAX_CONTENT_LENGTH"] = (
+    int(os.environ["MAX_REQUEST_MB"]) * 1024 * 1024 if os.getenv("MAX_REQUEST_MB")
+    else MAX_LISTING_PHOTOS * MAX_UPLOAD_BYTES + 1024 * 1024
+)
+
+# Search result cache (SEARCH_CACHE_PATH — общий SQLite-файл для всех воркеров)
+app.config["SEARCH_CACHE_SIZE"] = int(os.getenv("SEARCH_CACHE_SIZE", 1024))
+app.config["SEARCH_CACHE_TTL"] = int(os.getenv("SEARCH_CACHE_TTL", 300))
+app.config["SEARCH_CACHE_PATH"] = os.getenv("SEARCH_CACHE_PATH")
+
+# Эмбеддинги новых/изменённых объявлений считаются в фоне (EMBED_ON_WRITE=0 — только build_embeddings.py)
+app.config["EMBED_ON_WRITE"] = os.getenv("EMBED_ON_WRITE", "1") == "1"
+
+# Общий пул для фото: приём загрузок и превью (card / detail, JPEG + WebP) в фоне
+app.config["IMAGE_WORKERS"] = int(os.getenv("IMAGE_WORKERS", min(4, os.cpu_count() or 1)))
 
 # ----------------------------
 # Babel / i18n
@@ -81,9 +116,25 @@ def select_locale():
 babel = Babel(app, locale_selector=select_locale)
 
 db.init_app(app)
+listing_cache.init_app(app)
+embedding_queue.init_app(app)
+image_variants.init_app(app)
+blob_store.init_app(app)
+file_sweeper.init_app(app)
 
 with app.app_context():
     db.create_all()
+    ensure_fulltext_index()
+    ensure_catalogue_state()
+
+
+@app.after_request
+def cache_immutable_uploads(response):
+    # файлы blob store (и их варианты) адресуются хэшем содержимого и не меняются
+    path = request.path
+    if path.startswith(f"/static/uploads/{BLOB_DIR}/") or path.startswith(f"/static/uploads/variants/{BLOB_DIR}/"):
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
 
 
 # Make get_locale available in templates (so <html lang="{{ get_locale() }}"> works)
@@ -110,6 +161,150 @@ def inject_user():
     return dict(user=current_user, session=session)
 
 
+# ----------------------------
+# HELPERS
+# ----------------------------
+
+def attach_cover_images(listings):
+    """
+    Подгружает обложку (первое фото по sort_order, затем id) для целой
+    страницы объявлений одним запросом и кладёт её в item.image_filenames,
+    а её уменьшенные варианты — в item.cover_variants.
+    """
+    covers = {}
+    ids = [item.id for item in listings]
+    if ids:
+        rn = func.row_number().over(
+            partition_by=ListingImage.listing_id,
+            order_by=(ListingImage.sort_order.asc(), ListingImage.id.asc())
+        ).label("rn")
+        ranked = (
+            db.session.query(ListingImage.listing_id, ListingImage.filename, ListingImage.variants, rn)
+            .filter(ListingImage.listing_id.in_(ids))
+            .subquery()
+        )
+        rows = db.session.query(ranked.c.listing_id, ranked.c.filename, ranked.c.variants) \
+            .filter(ranked.c.rn == 1) \
+            .all()
+        covers = {listing_id: (filename, variants) for listing_id, filename, variants in rows}
+
+    for item in listings:
+        cover, variants = covers.get(item.id, (None, None))
+        item.image_filenames = [cover] if cover else []
+        item.cover_variants = variants or {}
+    return listings
+
+
+def listing_card(item) -> dict:
+    """Карточка объявления для JSON-ответов (после attach_cover_images)."""
+    return {
+        "id": item.id,
+        "title": item.title,
+        "city": item.city,
+        "price": item.price,
+        "type": item.type,
+        "image": image_path(item.image_filenames[0], item.cover_variants) if item.image_filenames else None,
+        "avg_rating": item.avg_rating,
+        "review_count": item.review_count
+    }
+
+
+@app.template_global()
+def listings_url(**overrides):
+    """
+    URL /listings с текущими параметрами запроса и заменой части из них
+    (None удаляет параметр). Смена фильтра сбрасывает курсор.
+    """
+    args = request.args.to_dict()
+    if "cursor" not in overrides:
+        args.pop("cursor", None)
+    for key, value in overrides.items():
+        if value is None or value == "":
+            args.pop(key, None)
+        else:
+            args[key] = value
+    return url_for("listings", **args)
+
+
+def image_path(filename: str, variants: dict = None, size: str = "card") -> str:
+    """Путь внутри UPLOAD_FOLDER: JPEG-вариант нужного размера, если он уже готов, иначе оригинал."""
+    return ((variants or {}).get(size) or {}).get("jpeg") or filename
+
+
+def stage_listing_image(f):
+    """
+    Работа в пуле: запись на диск с хэшем, проверка, что это картинка (None —
+    не картинка), и удаление EXIF/GPS без перекодирования — оригинал отдаётся
+    публично. Хэш blob-а — по очищенному файлу.
+    """
+    staged = blob_store.stage(f)
+    try:
+        if not is_image(staged.tmp_path):
+            blob_store.discard([staged])
+            return None
+        stripped = strip_metadata(staged.tmp_path, staged.mime)
+    except ValueError:
+        blob_store.discard([staged])
+        return None
+    except BaseException:
+        blob_store.discard([staged])
+        raise
+    if stripped is not None:
+        staged = staged._replace(sha256=stripped.sha256, size=stripped.size)
+    return staged
+
+
+def stage_listing_images(files) -> list:
+    """
+    Пишет и проверяет загруженные фото параллельно в общем пуле image_variants,
+    не трогая базу. Файлы, которые не открываются как изображение, пропускаются.
+    Если какой-то файл не записан (413 и т.п.), временные файлы остальных
+    удаляются и исключение пробрасывается — до любых записей в базу.
+    """
+    files = [f for f in files if f and f.filename]
+    if not files:
+        return []
+
+    futures = image_variants.run(stage_listing_image, files)
+    staged = [f.result() for f in futures if f.exception() is None and f.result() is not None]
+    errors = [f.exception() for f in futures if f.exception() is not None]
+    if errors:
+        blob_store.discard(staged)
+        raise errors[0]
+    return staged
+
+
+def add_listing_images(listing_id: int, staged) -> list:
+    """
+    Переносит подготовленные фото в blob store и добавляет строки ListingImage
+    одним bulk insert в текущей транзакции. Возвращает id новых ListingImage.
+    """
+    if not staged:
+        return []
+    current_max = db.session.query(func.max(ListingImage.sort_order)).filter_by(listing_id=listing_id).scalar() or 0
+    rows = [
+        {"listing_id": listing_id, "filename": filename, "sort_order": current_max + i}
+        for i, filename in enumerate(blob_store.store(staged), start=1)
+    ]
+    db.session.bulk_insert_mappings(ListingImage, rows)
+    # id — одним запросом после вставки (RETURNING на SQLite шёл бы построчно)
+    return [image_id for (image_id,) in db.session.query(ListingImage.id).filter(
+        ListingImage.listing_id == listing_id, ListingImage.sort_order > current_max
+    ).order_by(ListingImage.sort_order)]
+
+
+@app.template_global()
+def image_url(filename: str, variants: dict = None, size: str = "card") -> str:
+    return f"/static/uploads/{image_path(filename, variants, size)}"
+
+
+@app.template_global()
+def image_srcset(variants: dict, fmt: str = "jpeg") -> str:
+    """srcset из вариантов фото: "/static/uploads/..._card.webp 480w, ..._detail.webp 1280w"."""
+    by_width = {entry["width"]: entry for entry in (variants or {}).values() if fmt in entry}
+    return ", ".join(f"/static/uploads/{by_width[width][fmt]} {width}w" for width in sorted(by_width))
+
+
 # ----------------------------
 # ROUTES
 # ----------------------------
@@ -119,12 +314,7 @@ def index():
     if "user_id" in session:
         return redirect("/index_logged")
 
-    listings = Listing.query.limit(4).all()
-    for item in listings:
-        image = ListingImage.query.filter_by(listing_id=item.id) \
-            .order_by(ListingImage.sort_order.asc(), ListingImage.id.asc()) \
-            .first()
-        item.image_filenames = [image.filename] if image else []
+    listings = attach_cover_images(front_page_listings())
 
     return render_template("index.html", listings=listings)
 
@@ -135,13 +325,7 @@ def index_logged():
         return redirect("/login")
 
     user = User.query.get(session["user_id"])
-    listings = Listing.query.limit(4).all()
-
-    for item in listings:
-        image = ListingImage.query.filter_by(listing_id=item.id) \
-            .order_by(ListingImage.sort_order.asc(), ListingImage.id.asc()) \
-            .first()
-        item.image_filenames = [image.filename] if image else []
+    listings = attach_cover_images(front_page_listings())
 
     return render_template("index_logged.html", user=user, listings=listings)
 
@@ -221,34 +405,62 @@ def logout():
 
 @app.route("/listings")
 def listings():
-    city = request.args.get("city", "")
-    min_price = request.args.get("min_price", "")
-    max_price = request.args.get("max_price", "")
-    type_ = request.args.get("type", "")
+    filters = parse_listing_filters(request.args)
+    sort = parse_sort(request.args.get("sort", ""), filters)
 
-    query = Listing.query
+    results, next_cursor = search_listings_page(filters, sort, request.args.get("cursor", ""))
+    attach_cover_images(results)
 
-    if city:
-        query = query.filter(Listing.city.ilike(f"%{city}%"))
-    if min_price:
-        query = query.filter(Listing.price >= int(min_price))
-    if max_price:
-        query = query.filter(Listing.price <= int(max_price))
-    if type_:
-        query = query.filter(Listing.type == type_)
-
-    results = query.all()
-
-    for item in results:
-        image = (
-            ListingImage.query
-            .filter_by(listing_id=item.id)
-            .order_by(ListingImage.sort_order.asc(), ListingImage.id.asc())
-            .first()
-        )
-        item.image_filenames = [image.filename] if image else []
+    next_url = listings_url(cursor=next_cursor) if next_cursor else None
+
+    return render_template(
+        "listings.html",
+        listings=results,
+        filters=filters,
+        facets=listing_facets(filters),
+        sort=sort,
+        next_url=next_url
+    )
+
+
+@app.route("/api/listings")
+def api_listings():
+    """JSON-вариант /listings для бесконечной прокрутки (те же q, фильтры, sort, cursor)."""
+    filters = parse_listing_filters(request.args)
+    sort = parse_sort(request.args.get("sort", ""), filters)
+
+    cursor = request.args.get("cursor", "")
+    results, next_cursor = search_listings_page(filters, sort, cursor)
+    attach_cover_images(results)
 
-    return render_template("listings.html", listings=results)
+    payload = {
+        "items": [listing_card(item) for item in results],
+        "next_cursor": next_cursor
+    }
+    if not cursor:
+        payload["facets"] = listing_facets(filters)
+    return jsonify(payload)
+
+
+@app.route("/api/cities")
+def api_cities():
+    """Автодополнение города: ?q=mün -> ["München", ...]."""
+    return jsonify(city_index.suggest(request.args.get("q", "")))
+
+
+@app.route("/api/listing-duplicates", methods=["POST"])
+def api_listing_duplicates():
+    """
+    Проверка на дубликаты до отправки формы создания: форма спрашивает её
+    перед загрузкой фото, чтобы при найденном дубликате не терять выбранные файлы.
+    """
+    if "user_id" not in session or session.get("role") != "landlord":
+        return jsonify([]), 403
+    duplicates = find_duplicates(request.form.get("title"), request.form.get("description"))
+    return jsonify([
+        {"id": other.id, "title": other.title, "city": other.city, "score": round(score, 3)}
+        for other, score in duplicates
+    ])
 
 
 @app.route("/listing/<int:id>")
@@ -262,11 +474,14 @@ def listing_detail(id):
     images = ListingImage.query.filter_by(listing_id=id).order_by(ListingImage.sort_order.asc(),
                                                                   ListingImage.id.asc()).all()
 
+    similar = attach_cover_images(similar_listings(id))
+
     return render_template(
         "listing_detail.html",
         listing=listing,
         images=images,
-        reviews=reviews
+        reviews=reviews,
+        similar=similar
     )
 
 @app.route("/listing/<int:id>/update-description", methods=["POST"])
@@ -282,7 +497,11 @@ def update_listing_description(id):
 
     new_desc = (request.form.get("description") or "").strip()
     listing.description = new_desc
+    index_listing_text(listing)
+    index_listing_shingles(listing)
+    bump_catalogue_version()
     db.session.commit()
+    embedding_queue.enqueue(listing.id)
 
     return redirect(f"/listing/{id}")
 
@@ -318,6 +537,7 @@ def reorder_listing_images(listing_id):
             images_by_id[img_id].sort_order = order
             order += 1
 
+    bump_catalogue_version()
     db.session.commit()
     return jsonify({"ok": True})
 
@@ -326,50 +546,26 @@ def reorder_listing_images(listing_id):
 # AI SEARCH
 # ----------------------------
 
-#@app.route("/ai-search", methods=["POST"])
-#def ai_search():
-#    data = request.get_json(silent=True) or {}
-#    query_text = (data.get("query") or "").strip()
-#
-#    if not query_text:
-#        return jsonify([])
-#
-#    query_emb = get_embedding(query_text)
-#
-#    listings_ = Listing.query.filter(Listing.embedding.isnot(None)).all()
-#    if not listings_:
-#        return jsonify([])
-#
-#    scored = []
-#    for item in listings_:
-#        if not item.embedding:
-#            continue
-#        sim = cosine_sim(query_emb, item.embedding)
-#        scored.append((sim, item))
-#
-#    if not scored:
-#        return jsonify([])
-#
-#    scored.sort(key=lambda x: x[0], reverse=True)
-#    top_items = [item for sim, item in scored[:10]]
-#
-#    results = []
-#    for item in top_items:
-#        image = (
-#            ListingImage.query
-#            .filter_by(listing_id=item.id)
-#            .order_by(ListingImage.sort_order.asc(), ListingImage.id.asc())
-#            .first()
-#        )
-#        results.append({
-#            "id": item.id,
-#            "title": item.title,
-#            "city": item.city,
-#            "price": item.price,
-#            "image": image.filename if image else None
-#        })
-#
-#    return jsonify(results)
+@app.route("/ai-search", methods=["POST"])
+def ai_search():
+    data = request.get_json(silent=True) or {}
+    query_text = (data.get("query") or "").strip()
+
+    if not query_text:
+        return jsonify([])
+
+    index = ensure_listing_index(EMBED_MODEL)
+    if not len(index):
+        return jsonify([])
+
+    # те же фильтры, что у /listings (city, min_price, max_price, type) — в теле запроса
+    filters = parse_listing_filters(data)
+    query_emb = get_query_embedding(query_text)
+
+    top = index.search(query_emb, k=10, filters=filters)
+    items = attach_cover_images(load_listings([listing_id for listing_id, _ in top]))
+
+    return jsonify([listing_card(item) for item in items])
 
 
 # ----------------------------
@@ -388,36 +584,45 @@ def create_listing():
         type_ = request.form.get("type")
         desc = request.form.get("description")
 
-        listing = Listing(
-            title=title,
-            city=city,
-            price=int(price),
-            type=type_,
-            description=desc,
-            user_id=session["user_id"]
-        )
-
-        db.session.add(listing)
-        db.session.commit()
-
-        files = request.files.getlist("images[]")
-        current_max = db.session.query(func.max(ListingImage.sort_order)).filter_by(listing_id=listing.id).scalar() or 0
+        # похожее объявление уже есть — показываем его и просим подтвердить публикацию.
+        # Форма сначала спрашивает /api/listing-duplicates и до сюда доходит без фото
+        # только без JS: тогда говорим, что фото нужно выбрать заново
+        duplicates = find_duplicates(title, desc)
+        if duplicates and not request.form.get("confirm_duplicate"):
+            photos_dropped = any(f and f.filename for f in request.files.getlist("images[]"))
+            return render_template(
+                "create_listing.html", duplicates=duplicates, form=request.form, photos_dropped=photos_dropped
+            )
 
-        for f in files:
-            if f.filename:
-                filename = secure_filename(f.filename)
-                path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-                f.save(path)
+        # фото пишутся и проверяются до записи в базу: 413 или битый файл не оставят объявление без фото
+        price = int(price)
+        staged = stage_listing_images(request.files.getlist("images[]"))
 
-                current_max += 1
-                img = ListingImage(
-                    filename=filename,
-                    listing_id=listing.id,
-                    sort_order=current_max
-                )
-                db.session.add(img)
+        try:
+            listing = Listing(
+                title=title,
+                city=city,
+                price=price,
+                type=type_,
+                description=desc,
+                user_id=session["user_id"]
+            )
 
-        db.session.commit()
+            db.session.add(listing)
+            db.session.flush()
+            index_listing_text(listing)
+            index_listing_shingles(listing)
+            for other, score in duplicates:
+                record_duplicate(listing.id, other.id, "minhash", score)
+            new_images = add_listing_images(listing.id, staged)
+            bump_catalogue_version()
+            db.session.commit()
+        except BaseException:
+            blob_store.discard(staged)
+            raise
+        city_index.invalidate()
+        embedding_queue.enqueue(listing.id)
+        image_variants.submit(new_images)
         return redirect("/my-listings")
 
     return render_template("create_listing.html")
@@ -435,46 +640,73 @@ def edit_listing(id):
         return redirect("/login")
 
     if request.method == "POST":
-        listing.title = request.form.get("title")
-        listing.city = request.form.get("city")
-        listing.price = int(request.form.get("price"))
-        listing.type = request.form.get("type")
-        listing.description = request.form.get("description")
-
-        files = request.files.getlist("images[]")
-        current_max = db.session.query(func.max(ListingImage.sort_order)).filter_by(listing_id=listing.id).scalar() or 0
-
-        for f in files:
-            if f and f.filename:
-                filename = secure_filename(f.filename)
-                path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-                f.save(path)
-
-                current_max += 1
-                img = ListingImage(
-                    filename=filename,
-                    listing_id=listing.id,
-                    sort_order=current_max
-                )
-                db.session.add(img)
+        # фото пишутся до записей в базу: пока идёт запись файлов, запрос
+        # не держит блокировку базы, нужную фоновым потокам
+        price = int(request.form.get("price"))
+        staged = stage_listing_images(request.files.getlist("images[]"))
 
-        db.session.commit()
+        try:
+            listing.title = request.form.get("title")
+            listing.city = request.form.get("city")
+            listing.price = price
+            listing.type = request.form.get("type")
+            listing.description = request.form.get("description")
+            index_listing_text(listing)
+            index_listing_shingles(listing)
+            new_images = add_listing_images(listing.id, staged)
+
+            bump_catalogue_version()
+            db.session.commit()
+        except BaseException:
+            blob_store.discard(staged)
+            raise
+        city_index.invalidate()
+        listing_index.set_attributes(listing.id, listing_attributes(listing))
+        embedding_queue.enqueue(listing.id)
+        image_variants.submit(new_images)
         return redirect("/my-listings")
 
     images = ListingImage.query.filter_by(listing_id=id).all()
     return render_template("edit_listing.html", listing=listing, images=images)
 
 
+@app.errorhandler(413)
+def upload_too_large(e):
+    """
+    Загрузка больше MAX_CONTENT_LENGTH или MAX_UPLOAD_MB: форму объявления
+    показываем снова с ошибкой вместо голой страницы 413. Если не прочитано
+    всё тело запроса, заполненные поля потеряны — werkzeug их не разбирал.
+    """
+    if request.endpoint not in ("create_listing", "edit_listing"):
+        return e
+    try:
+        form = request.form
+    except RequestEntityTooLarge:
+        form = {}
+    upload_error = _(
+        "Фотографии слишком большие: не больше %(file)s МБ на фото и %(total)s МБ за раз.",
+        file=MAX_UPLOAD_BYTES // (1024 * 1024),
+        total=app.config["MAX_CONTENT_LENGTH"] // (1024 * 1024)
+    )
+    if request.endpoint == "create_listing":
+        return render_template("create_listing.html", form=form, upload_error=upload_error), 413
+
+    listing = Listing.query.get_or_404(request.view_args["id"])
+    if "user_id" not in session or listing.user_id != session["user_id"]:
+        return redirect("/login")
+    images = ListingImage.query.filter_by(listing_id=listing.id).all()
+    return render_template("edit_listing.html", listing=listing, images=images, upload_error=upload_error), 413
+
+
 @app.route("/delete-image/<int:id>")
 def delete_image(id):
     img = ListingImage.query.get_or_404(id)
-    try:
-        os.remove(os.path.join(app.config["UPLOAD_FOLDER"], img.filename))
-    except FileNotFoundError:
-        pass
+    blob_store.release(img.filename, img.variants)
     listing_id = img.listing_id
     db.session.delete(img)
+    bump_catalogue_version()
     db.session.commit()
+    file_sweeper.wake()
     return redirect(f"/edit-listing/{listing_id}")
 
 
@@ -487,15 +719,9 @@ def my_listings():
     if "user_id" not in session:
         return redirect("/login")
 
-    listings_ = Listing.query.filter_by(user_id=session["user_id"]).all()
-
-    for item in listings_:
-        first = ListingImage.query \
-            .filter_by(listing_id=item.id) \
-            .order_by(ListingImage.sort_order.asc(), ListingImage.id.asc()) \
-            .first()
-
-        item.image_filenames = [first.filename] if first else []
+    listings_ = attach_cover_images(
+        Listing.query.filter_by(user_id=session["user_id"]).all()
+    )
 
     return render_template("my_listings.html", listings=listings_)
 
@@ -523,6 +749,18 @@ def dashboard():
 # REVIEWS
 # ----------------------------
 
+def adjust_rating_aggregates(listing_id: int, count_delta: int, rating_delta: int):
+    """
+    Атомарно сдвигает review_count / rating_sum объявления в текущей транзакции
+    (UPDATE ... SET x = x + delta, без read-modify-write).
+    """
+    Listing.query.filter_by(id=listing_id).update({
+        Listing.review_count: Listing.review_count + count_delta,
+        Listing.rating_sum: Listing.rating_sum + rating_delta,
+    }, synchronize_session=False)
+    bump_catalogue_version()
+
+
 @app.route("/listing/<int:listing_id>/review", methods=["POST"])
 def add_review(listing_id):
     if "user_id" not in session:
@@ -550,6 +788,7 @@ def add_review(listing_id):
     )
 
     db.session.add(new_review)
+    adjust_rating_aggregates(listing_id, 1, rating)
     db.session.commit()
 
     return redirect(f"/listing/{listing_id}")
@@ -565,9 +804,13 @@ def edit_review(review_id):
     if review.user_id != session["user_id"]:
         return "Нет доступа", 403
 
+    old_rating = review.rating
     review.rating = int(request.form.get("rating", review.rating))
     review.text = request.form.get("text", review.text)
 
+    if review.rating != old_rating:
+        adjust_rating_aggregates(review.listing_id, 0, review.rating - old_rating)
+
     db.session.commit()
     return redirect(f"/listing/{review.listing_id}")
 
@@ -583,6 +826,7 @@ def delete_review(review_id):
         return "Нет доступа", 403
 
     listing_id = review.listing_id
+    adjust_rating_aggregates(listing_id, -1, -review.rating)
     db.session.delete(review)
     db.session.commit()
 
@@ -805,14 +1049,6 @@ def audit(deal_id: int, action: str, meta: str = ""):
         db.session.rollback()
 
 
-def sha256_file(path: str) -> str:
-    h = hashlib.sha256()
-    with open(path, "rb") as f:
-        for chunk in iter(lambda: f.read(1024 * 1024), b""):
-            h.update(chunk)
-    return h.hexdigest()
-
-
 def generate_contract_pdf(path: str, deal: "Deal") -> None:
     """
     Variant A (MVP): generate an UNSIGNED contract PDF from Jinja2 template and
@@ -883,9 +1119,7 @@ def attach_contract_from_template(deal: "Deal", actor_id: int) -> DealContract:
     ts = datetime.utcnow().strftime("%Y%m%d%H%M%S")
     stored = f"contract_unsigned_{ts}.pdf"
     dst_path = os.path.join(folder, stored)
-    shutil.copyfile(template_pdf, dst_path)
-
-    unsigned_sha = sha256_file(dst_path)
+    unsigned_sha = copy_file(template_pdf, dst_path).sha256
 
     # 4) Создаём/обновляем запись в БД
     if existing:
@@ -1044,9 +1278,7 @@ def deal_generate_contract(deal_id):
     ts = datetime.utcnow().strftime("%Y%m%d%H%M%S")
     stored = f"contract_unsigned_{ts}.pdf"
     dst_path = os.path.join(folder, stored)
-    shutil.copyfile(template_pdf, dst_path)
-
-    unsigned_sha = sha256_file(dst_path)
+    unsigned_sha = copy_file(template_pdf, dst_path).sha256
 
     existing = DealContract.query.filter_by(deal_id=deal.id).first()
     if existing:
@@ -1100,9 +1332,7 @@ def deal_upload_signed_contract(deal_id):
     ts = datetime.utcnow().strftime("%Y%m%d%H%M%S")
     stored = f"contract_signed_{role}_{ts}_{filename}"
     path = os.path.join(folder, stored)
-    f.save(path)
-
-    signed_sha = sha256_file(path)
+    signed_sha = save_upload(f, path).sha256
 
     existing = DealContractSigned.query.filter_by(contract_id=contract.id, party=role).first()
     if existing:
@@ -1157,7 +1387,7 @@ def deal_upload_document(deal_id):
     ts = datetime.utcnow().strftime("%Y%m%d%H%M%S")
     stored = f"{role}_{doc_type}_{ts}_{filename}"
     path = os.path.join(folder, stored)
-    f.save(path)
+    upload = save_upload(f, path)
 
     doc = DealDocument(
         deal_id=deal.id,
@@ -1165,6 +1395,9 @@ def deal_upload_document(deal_id):
         party=role,
         doc_type=doc_type,
         filename=f"uploads/deals/{deal.id}/{stored}",
+        sha256=upload.sha256,
+        size=upload.size,
+        mime=upload.mime,
         status="pending"
     )
     db.session.add(doc)
@@ -1174,7 +1407,7 @@ def deal_upload_document(deal_id):
     deal.touch()
 
     db.session.commit()
-    audit(deal.id, "doc_upload", f"type={doc_type},file={doc.filename}")
+    audit(deal.id, "doc_upload", f"type={doc_type},file={doc.filename},sha256={doc.sha256}")
 
     return redirect(f"/deal/{deal.id}")
 
@@ -1336,10 +1569,6 @@ def admin_delete_listing(listing_id):
 
     deals = Deal.query.filter_by(listing_id=listing.id).all()
     for deal in deals:
-        deal_folder = os.path.join(app.config["UPLOAD_FOLDER"], "deals", str(deal.id))
-        if os.path.exists(deal_folder):
-            shutil.rmtree(deal_folder)
-
         DealDocument.query.filter_by(deal_id=deal.id).delete()
         DealAudit.query.filter_by(deal_id=deal.id).delete()
 
@@ -1347,14 +1576,27 @@ def admin_delete_listing(listing_id):
 
     images = ListingImage.query.filter_by(listing_id=listing.id).all()
     for img in images:
-        try:
-            os.remove(os.path.join(app.config["UPLOAD_FOLDER"], img.filename))
-        except FileNotFoundError:
-            pass
+        blob_store.release(img.filename, img.variants)
         db.session.delete(img)
 
+    unindex_listing(listing.id)
+    remove_similar(listing.id)
+    unindex_listing_shingles(listing.id)
     db.session.delete(listing)
-    db.session.commit()
+    bump_catalogue_version()
+
+    # папки сделок уходят в корзину под уникальным именем (id сделки может
+    # достаться новой), удаляет их file_sweeper после commit
+    moved = [bury_dir(app.config["UPLOAD_FOLDER"], f"deals/{deal.id}") for deal in deals]
+    try:
+        db.session.commit()
+    except BaseException:
+        db.session.rollback()
+        restore_dirs(moved)
+        raise
+    listing_index.remove(listing_id)
+    city_index.invalidate()
+    file_sweeper.wake()
 
     return redirect("/admin/listings")
 
@@ -1364,15 +1606,25 @@ def admin_listings():
     if not require_admin():
         return redirect("/login")
 
-    listings_ = Listing.query.order_by(Listing.created_at.desc()).all()
-
-    for item in listings_:
-        image = ListingImage.query.filter_by(listing_id=item.id) \
-            .order_by(ListingImage.sort_order.asc(), ListingImage.id.asc()) \
-            .first()
-        item.image_filenames = [image.filename] if image else []
-
-    return render_template("admin_listings.html", listings=listings_)
+    # ?view=duplicates — только объявления, найденные как почти-дубликаты более старых
+    view = request.args.get("view")
+    query = Listing.query
+    if view == "duplicates":
+        query = query.filter(
+            Listing.id.in_(db.session.query(ListingDuplicate.listing_id))
+        )
+    listings_ = attach_cover_images(query.order_by(Listing.created_at.desc()).all())
+
+    if view == "duplicates":
+        by_listing = {}
+        for dup in ListingDuplicate.query.filter(
+            ListingDuplicate.listing_id.in_([item.id for item in listings_])
+        ).order_by(ListingDuplicate.score.desc()):
+            by_listing.setdefault(dup.listing_id, []).append(dup)
+        for item in listings_:
+            item.duplicates = by_listing.get(item.id, [])
+
+    return render_template("admin_listings.html", listings=listings_, view=view)
 
 
 @app.route("/deal/<int:deal_id>/dates", methods=["POST"])
@@ -0,0 +1,119 @@
+# bench_vector_index.py
+# Recall@k, латентность и занимаемая память IVF- и сжатых индексов
+# относительно точного brute-force поиска.
+#
+#   python bench_vector_index.py --n 200000 --dim 768 --nprobe 4,8,16,32
+#   python bench_vector_index.py --compress truncate:512,pca:256 --rerank 1,4
+#   python bench_vector_index.py --from-db          # эмбеддинги из базы
+import argparse
+import time
+
+import numpy as np
+
+from vector_index import VectorIndex, IVFIndex, QuantizedIndex, normalize_rows
+
+
+def synthetic_embeddings(n: int, dim: int, clusters: int = 512, seed: int = 0):
+    """Смесь гауссиан на сфере — грубое приближение к эмбеддингам объявлений."""
+    rng = np.random.default_rng(seed)
+    centers = normalize_rows(rng.normal(size=(clusters, dim)))
+    labels = rng.integers(0, clusters, size=n)
+    noise = rng.normal(scale=0.6 / np.sqrt(dim), size=(n, dim)).astype(np.float32)
+    return normalize_rows(centers[labels] + noise)
+
+
+def db_embeddings():
+    from app import app
+    from vector_index import load_embedding_matrix
+
+    with app.app_context():
+        ids, matrix = load_embedding_matrix()
+    return normalize_rows(matrix)
+
+
+def timed_search(index, queries, k):
+    results, latencies = [], []
+    for q in queries:
+        start = time.perf_counter()
+        results.append([listing_id for listing_id, _ in index.search(q, k)])
+        latencies.append((time.perf_counter() - start) * 1000)
+    return results, np.array(latencies)
+
+
+def recall(results, truth, k):
+    hits = sum(len(set(r[:k]) & set(t[:k])) for r, t in zip(results, truth))
+    return hits / (k * len(truth))
+
+
+def megabytes(index) -> str:
+    return f"{index.memory_bytes() / 2**20:.1f}MB ({index.memory_bytes() / max(len(index), 1):.0f}B/vec)"
+
+
+def bench_compression(spec, ids, vectors, queries, truth, args):
+    """spec — "truncate:512,pca:256"; rerank=1 означает поиск только по int8-кодам."""
+    for item in spec.split(","):
+        method, dims = item.split(":")
+        index = QuantizedIndex(dims=int(dims), method=method, loader=lambda rows: vectors[rows])
+        start = time.perf_counter()
+        index.build(ids, vectors)
+        print(f"{method}:{dims}  build {time.perf_counter() - start:.1f}s, {megabytes(index)}")
+
+        for rerank in [int(r) for r in args.rerank.split(",")]:
+            index.rerank = rerank
+            index.loader = (lambda rows: vectors[rows]) if rerank > 1 else None
+            results, latencies = timed_search(index, queries, args.k)
+            print(f"    rerank={rerank:<3} recall@{args.k}={recall(results, truth, args.k):.3f}  "
+                  f"p50={np.percentile(latencies, 50):.2f}ms  p99={np.percentile(latencies, 99):.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall, latency and memory of IVF / compressed vs brute-force search")
+    parser.add_argument("--n", type=int, default=100_000)
+    parser.add_argument("--dim", type=int, default=3072)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, default=None)
+    parser.add_argument("--nprobe", default="1,4,8,16,32")
+    parser.add_argument("--compress", default="", help="e.g. truncate:512,pca:256")
+    parser.add_argument("--rerank", default="1,4")
+    parser.add_argument("--skip-ivf", action="store_true")
+    parser.add_argument("--from-db", action="store_true")
+    args = parser.parse_args()
+
+    if args.from_db:
+        vectors = db_embeddings()
+    else:
+        vectors = synthetic_embeddings(args.n + args.queries, args.dim)
+    if len(vectors) <= args.queries:
+        raise SystemExit("Not enough embeddings for the benchmark")
+
+    queries, vectors = vectors[:args.queries], vectors[args.queries:]
+    ids = np.arange(len(vectors))
+    print(f"{len(vectors)} vectors x {vectors.shape[1]} dims, {len(queries)} queries, k={args.k}")
+
+    brute = VectorIndex()
+    brute.build(ids, vectors)
+    truth, latencies = timed_search(brute, queries, args.k)
+    print(f"brute  recall@{args.k}=1.000  "
+          f"p50={np.percentile(latencies, 50):.2f}ms  p99={np.percentile(latencies, 99):.2f}ms  "
+          f"{megabytes(brute)}")
+
+    if args.compress:
+        bench_compression(args.compress, ids, vectors, queries, truth, args)
+    if args.skip_ivf:
+        return
+
+    ivf = IVFIndex(nlist=args.nlist)
+    start = time.perf_counter()
+    ivf.build(ids, vectors)
+    print(f"ivf    build {time.perf_counter() - start:.1f}s, nlist={len(ivf._centroids)}")
+
+    for nprobe in [int(p) for p in args.nprobe.split(",")]:
+        ivf.nprobe = nprobe
+        results, latencies = timed_search(ivf, queries, args.k)
+        print(f"ivf    nprobe={nprobe:<4} recall@{args.k}={recall(results, truth, args.k):.3f}  "
+              f"p50={np.percentile(latencies, 50):.2f}ms  p99={np.percentile(latencies, 99):.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
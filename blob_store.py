@@ -0,0 +1,159 @@
+# blob_store.py
+# Контентно-адресуемое хранилище загруженных фото: файл лежит в
+# UPLOAD_FOLDER/blobs/ab/cd/<sha256><ext>, одинаковые фото хранятся один раз,
+# а таблица blob считает ссылки (ListingImage) на каждый файл. Файл удаляется,
+# только когда на него не осталось ссылок (через надгробие, см. file_sweeper.py).
+# Содержимое по такому пути никогда не меняется, поэтому его можно кэшировать
+# навсегда (Cache-Control: immutable). Старые фото с плоскими именами
+# (до blob store) удаляются без подсчёта ссылок.
+import os
+import re
+from collections import Counter, namedtuple
+
+from sqlalchemy import select, update, delete
+from werkzeug.utils import secure_filename
+
+from models import db, Blob, FileTombstone
+from upload_sink import write_temp
+from image_variants import VARIANT_FORMATS, VARIANT_WIDTHS, variant_filename
+
+BLOB_DIR = "blobs"
+# загрузка, записанная во временный файл, но ещё не перенесённая в хранилище
+StagedBlob = namedtuple("StagedBlob", "tmp_path ext sha256 size mime")
+
+_BLOB_RE = re.compile(rf"^{BLOB_DIR}/[0-9a-f]{{2}}/[0-9a-f]{{2}}/([0-9a-f]{{64}})(\.\w+)?$")
+
+
+def blob_digest(filename: str):
+    """sha256 для пути из blob store, None — для старых плоских имён."""
+    match = _BLOB_RE.match(filename or "")
+    return match.group(1) if match else None
+
+
+def blob_filename(digest: str, ext: str) -> str:
+    return f"{BLOB_DIR}/{digest[:2]}/{digest[2:4]}/{digest}{ext}"
+
+
+def blob_paths(filename: str) -> list:
+    """Оригинал и все возможные варианты blob-а (их имена выводятся из имени файла)."""
+    return [filename] + [
+        variant_filename(filename, size, ext)
+        for size in VARIANT_WIDTHS for ext, _ in VARIANT_FORMATS.values()
+    ]
+
+
+class BlobStore:
+    def __init__(self):
+        self.root = None
+
+    def init_app(self, app):
+        self.root = app.config["UPLOAD_FOLDER"]
+
+    def stage(self, file_storage) -> StagedBlob:
+        """
+        Файловая часть сохранения: пишет загрузку во временный файл (upload_sink:
+        sha256 и лимит размера по ходу чтения). Базу не трогает, поэтому
+        можно вызывать из пула потоков.
+        """
+        ext = os.path.splitext(secure_filename(file_storage.filename or ""))[1].lower()
+        tmp_path, upload = write_temp(file_storage.stream, os.path.join(self.root, BLOB_DIR, "tmp"))
+        return StagedBlob(tmp_path, ext, upload.sha256, upload.size, upload.mime)
+
+    def discard(self, staged):
+        for item in staged:
+            try:
+                os.remove(item.tmp_path)
+            except FileNotFoundError:
+                pass
+
+    def store(self, staged) -> list:
+        """
+        Добавляет ссылки в blob в текущей транзакции (один SELECT на всю пачку,
+        UPDATE на каждый уже известный хэш и bulk insert новых), затем переносит
+        подготовленные файлы на место по хэшу (или выбрасывает, если такой файл
+        уже есть). Файлы ставятся после записи в базу: если file_sweeper как раз
+        удаляет этот blob, запись дождётся его commit и файл будет положен заново.
+        Возвращает пути в том же порядке.
+        """
+        digests = {item.sha256 for item in staged}
+        existing = {
+            blob.sha256: blob.filename
+            for blob in Blob.query.filter(Blob.sha256.in_(digests))
+        } if digests else {}
+
+        filenames, added, new = [], Counter(), {}
+        for item in staged:
+            filename = existing.get(item.sha256) or blob_filename(item.sha256, item.ext)
+            if item.sha256 in existing:
+                added[item.sha256] += 1
+            elif item.sha256 in new:
+                new[item.sha256]["refcount"] += 1
+            else:
+                new[item.sha256] = {"sha256": item.sha256, "filename": filename, "size": item.size, "refcount": 1}
+            filenames.append(filename)
+
+        sizes = {item.sha256: item.size for item in staged}
+        for digest, count in added.items():
+            updated = db.session.execute(
+                update(Blob).where(Blob.sha256 == digest).values(refcount=Blob.refcount + count)
+            ).rowcount
+            if not updated:
+                # blob удалили между SELECT и UPDATE
+                new[digest] = {"sha256": digest, "filename": existing[digest], "size": sizes[digest], "refcount": count}
+        if new:
+            db.session.bulk_insert_mappings(Blob, list(new.values()))
+
+        for item, filename in zip(staged, filenames):
+            path = os.path.join(self.root, filename)
+            if os.path.exists(path):
+                os.remove(item.tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(item.tmp_path, path)
+        return filenames
+
+    def acquire(self, digest: str, filename: str, size: int):
+        updated = db.session.execute(
+            update(Blob).where(Blob.sha256 == digest).values(refcount=Blob.refcount + 1)
+        ).rowcount
+        if not updated:
+            db.session.add(Blob(sha256=digest, filename=filename, size=size, refcount=1))
+            db.session.flush()
+
+    def release(self, filename: str, variants: dict = None):
+        """
+        Снимает ссылку и оставляет надгробие (FileTombstone) в текущей транзакции.
+        Файл удалит file_sweeper после commit: blob — если на него не осталось
+        ссылок, старое плоское имя — вместе с его вариантами сразу.
+        """
+        digest = blob_digest(filename)
+        if digest is None:
+            paths = [filename] + [
+                entry[fmt] for entry in (variants or {}).values() for fmt in VARIANT_FORMATS if fmt in entry
+            ]
+        else:
+            db.session.execute(
+                update(Blob).where(Blob.sha256 == digest).values(refcount=Blob.refcount - 1)
+            )
+            paths = [filename]
+        db.session.add_all([FileTombstone(path=path) for path in dict.fromkeys(paths)])
+
+    def sweep(self, filename: str) -> bool:
+        """
+        Для file_sweeper, внутри его транзакции: удаляет строку blob без ссылок
+        и файлы (оригинал и варианты) до commit, пока держится блокировка записи —
+        store() в другом запросе дождётся её и положит файл заново.
+        False — на blob снова есть ссылки, файлы остаются.
+        """
+        digest = blob_digest(filename)
+        db.session.execute(delete(Blob).where(Blob.sha256 == digest, Blob.refcount <= 0))
+        if db.session.scalar(select(Blob.refcount).where(Blob.sha256 == digest)) is not None:
+            return False
+        for path in blob_paths(filename):
+            try:
+                os.remove(os.path.join(self.root, path))
+            except FileNotFoundError:
+                pass
+        return True
+
+blob_store = BlobStore()
@@ -1,19 +1,64 @@
 # build_embeddings.py
+# Инкрементальный пересчёт эмбеддингов объявлений:
+# - пропускает объявления, у которых не изменился текст (title, city, description) и модель;
+# - отправляет тексты пачками по EMBED_BATCH_SIZE, до EMBED_CONCURRENCY запросов параллельно;
+# - коммитит каждую пачку отдельно, так что после падения повторный запуск продолжит с места;
+# - если задан VECTOR_SNAPSHOT_DIR, в конце пишет новую версию memmap-снимка индекса.
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from app import app, db
 from models import Listing
-from ai_utils import get_embedding
+from ai_utils import get_embeddings, embedding_text, embedding_text_hash, EMBED_MODEL
+from embedding_queue import needs_embedding, save_embeddings
+from vector_index import SNAPSHOT_DIR, read_snapshot_header, write_snapshot
 
-with app.app_context():
-    listings = Listing.query.all()
+BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 100))
+CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", 4))
+
+
+def pending_listings():
+    """[(id, text, text_hash)] для объявлений, которым нужен новый эмбеддинг."""
+    rows = db.session.query(
+        Listing.id, Listing.title, Listing.city, Listing.description,
+        Listing.embedding_text_hash, Listing.embedding_model
+    ).order_by(Listing.id).all()
 
-    for listing in listings:
-        text = f"{listing.title}. {listing.city}. {listing.description or ''}"
+    pending = []
+    for listing_id, title, city, description, stored_hash, model in rows:
+        text = embedding_text(title, city, description)
+        text_hash = embedding_text_hash(text)
+        if needs_embedding(text_hash, stored_hash, model):
+            pending.append((listing_id, text, text_hash))
 
-        print(f"Embedding listing {listing.id} — {listing.title}")
-        embedding = get_embedding(text)
+    print(f"{len(pending)} of {len(rows)} listings need embeddings")
+    return pending
+
+
+with app.app_context():
+    pending = pending_listings()
+    batches = [pending[i:i + BATCH_SIZE] for i in range(0, len(pending), BATCH_SIZE)]
 
-        listing.embedding = embedding
+    done = failed = 0
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as pool:
+        futures = {
+            pool.submit(get_embeddings, [text for _, text, _ in batch]): batch
+            for batch in batches
+        }
+        # запись в базу — только из этого потока, по мере готовности пачек
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                save_embeddings(batch, future.result())
+                done += len(batch)
+                print(f"Embedded {done}/{len(pending)}")
+            except Exception as e:
+                db.session.rollback()
+                failed += len(batch)
+                print(f"Batch starting at listing {batch[0][0]} failed: {type(e).__name__}: {e}")
 
-    db.session.commit()
+    if SNAPSHOT_DIR and (done or read_snapshot_header() is None):
+        header = write_snapshot(EMBED_MODEL)
+        print(f"Snapshot v{header['version']}: {header['count']} vectors x {header['dim']} -> {SNAPSHOT_DIR}")
 
-print("Done! All embeddings created.")
+print(f"Done! {done} embedded, {failed} failed (rerun to retry).")
@@ -0,0 +1,44 @@
+# build_image_variants.py
+# Генерирует уменьшенные варианты (card / detail, JPEG + WebP) для уже
+# загруженных фото, у которых их ещё нет. Новые загрузки обрабатываются в фоне
+# самим приложением. Можно прерывать и запускать повторно.
+#
+#   python build_image_variants.py            # IMAGE_WORKERS=4
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app, db
+from models import ListingImage
+from image_variants import process_image, variants_available
+
+WORKERS = int(os.getenv("IMAGE_WORKERS", 4))
+
+
+def run(image_id: int):
+    with app.app_context():
+        try:
+            return process_image(image_id, app.config["UPLOAD_FOLDER"])
+        except Exception as e:
+            db.session.rollback()
+            print(f"Image {image_id} failed: {type(e).__name__}: {e}")
+            return False
+
+
+if not variants_available():
+    raise SystemExit("Pillow is not installed: pip install Pillow")
+
+with app.app_context():
+    pending = [
+        image_id for (image_id,) in
+        db.session.query(ListingImage.id).filter(ListingImage.variants.is_(None)).order_by(ListingImage.id)
+    ]
+print(f"{len(pending)} images need variants")
+
+done = 0
+with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+    for ok in pool.map(run, pending):
+        done += ok
+        if done and done % 100 == 0:
+            print(f"Processed {done}/{len(pending)}")
+
+print(f"Done! {done} images processed.")
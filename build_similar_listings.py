@@ -0,0 +1,18 @@
+# build_similar_listings.py
+# Полный пересчёт таблицы similar_listing ("Похожие объявления") по сохранённым
+# эмбеддингам. Между запусками таблицу точечно обновляет фоновая очередь
+# эмбеддингов; полный пересчёт возвращает точность и дополняет укоротившиеся списки.
+#
+#   python build_similar_listings.py          # SIMILAR_COUNT=8, SIMILAR_BLOCK=256
+import os
+
+from app import app
+from ai_utils import EMBED_MODEL
+from similar_listings import rebuild_similar_listings, SIMILAR_COUNT
+
+BLOCK = int(os.getenv("SIMILAR_BLOCK", 256))
+
+with app.app_context():
+    n = rebuild_similar_listings(EMBED_MODEL, SIMILAR_COUNT, BLOCK)
+
+print(f"Done! Similar listings rebuilt for {n} listings.")
@@ -0,0 +1,151 @@
+# duplicates.py
+# Поиск почти-дубликатов объявлений (повторные публикации той же квартиры):
+# MinHash-подпись по символьным шинглам title + description, LSH-бакеты лежат
+# в таблице listing_lsh_bucket, так что проверка — один запрос по первичному
+# ключу (band, bucket) и точный Jaccard для найденных кандидатов.
+# Найденные пары пишутся в listing_duplicate для отчёта /admin/listings?view=duplicates;
+# туда же фоновая очередь эмбеддингов добавляет пары с почти одинаковыми векторами.
+import hashlib
+import os
+import re
+import zlib
+
+import numpy as np
+from sqlalchemy import and_, or_
+
+from models import db, Listing, ListingLSHBucket, ListingDuplicate
+
+SHINGLE_SIZE = 5
+NUM_PERM = 64
+BANDS, ROWS = 16, 4  # порог срабатывания LSH ~ (1/16) ** (1/4) ≈ 0.5
+DUPLICATE_JACCARD = float(os.getenv("DUPLICATE_JACCARD", 0.8))
+DUPLICATE_EMBEDDING_SCORE = float(os.getenv("DUPLICATE_EMBEDDING_SCORE", 0.97))
+MAX_CANDIDATES = 50
+
+# универсальное хэширование (a * x + b) mod p: a < 2^31, x < 2^32 — без переполнения uint64
+_PRIME = np.uint64(4294967311)
+_rng = np.random.default_rng(20240601)
+_A = _rng.integers(1, 1 << 31, NUM_PERM, dtype=np.uint64)
+_B = _rng.integers(0, 1 << 32, NUM_PERM, dtype=np.uint64)
+
+
+def listing_shingles(title: str, description: str) -> set:
+    """crc32 символьных 5-грамм нормализованного текста (регистр, пунктуация, пробелы)."""
+    text = " ".join(re.findall(r"\w+", f"{title or ''} {description or ''}".casefold()))
+    if len(text) <= SHINGLE_SIZE:
+        return {zlib.crc32(text.encode("utf-8"))} if text else set()
+    return {
+        zlib.crc32(text[i:i + SHINGLE_SIZE].encode("utf-8"))
+        for i in range(len(text) - SHINGLE_SIZE + 1)
+    }
+
+
+def minhash(shingles: set) -> np.ndarray:
+    values = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))
+    return ((values[:, None] * _A + _B) % _PRIME).min(axis=0)
+
+
+def lsh_buckets(signature: np.ndarray) -> list:
+    """[(band, bucket)] — 64-битный хэш каждой полосы из ROWS значений подписи."""
+    return [
+        (band, int.from_bytes(
+            hashlib.blake2b(signature[band * ROWS:(band + 1) * ROWS].tobytes(), digest_size=8).digest(),
+            "little", signed=True
+        ))
+        for band in range(BANDS)
+    ]
+
+
+def jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def find_duplicates(title: str, description: str, exclude_id: int = None,
+                    threshold: float = DUPLICATE_JACCARD) -> list:
+    """[(Listing, jaccard)] по убыванию сходства."""
+    shingles = listing_shingles(title, description)
+    if not shingles:
+        return []
+
+    buckets = lsh_buckets(minhash(shingles))
+    candidates = db.session.query(ListingLSHBucket.listing_id).filter(or_(*[
+        and_(ListingLSHBucket.band == band, ListingLSHBucket.bucket == bucket)
+        for band, bucket in buckets
+    ]))
+    if exclude_id is not None:
+        candidates = candidates.filter(ListingLSHBucket.listing_id != exclude_id)
+    candidate_ids = [listing_id for (listing_id,) in candidates.distinct().limit(MAX_CANDIDATES)]
+    if not candidate_ids:
+        return []
+
+    matches = []
+    for listing in Listing.query.filter(Listing.id.in_(candidate_ids)):
+        score = jaccard(shingles, listing_shingles(listing.title, listing.description))
+        if score >= threshold:
+            matches.append((listing, score))
+    return sorted(matches, key=lambda match: -match[1])
+
+
+def index_listing_shingles(listing):
+    """Пересчитывает LSH-бакеты объявления (в текущей транзакции, как index_listing_text)."""
+    ListingLSHBucket.query.filter_by(listing_id=listing.id).delete(synchronize_session=False)
+    shingles = listing_shingles(listing.title, listing.description)
+    if not shingles:
+        return
+    db.session.bulk_insert_mappings(ListingLSHBucket, [
+        {"band": band, "bucket": bucket, "listing_id": listing.id}
+        for band, bucket in lsh_buckets(minhash(shingles))
+    ])
+
+
+def unindex_listing_shingles(listing_id: int):
+    ListingLSHBucket.query.filter_by(listing_id=listing_id).delete(synchronize_session=False)
+    ListingDuplicate.query.filter(
+        (ListingDuplicate.listing_id == listing_id) | (ListingDuplicate.duplicate_of_id == listing_id)
+    ).delete(synchronize_session=False)
+
+
+def record_duplicate(listing_id: int, other_id: int, method: str, score: float):
+    """Запоминает пару для отчёта; более новое объявление — дубликат более старого."""
+    listing_id, other_id = max(listing_id, other_id), min(listing_id, other_id)
+    existing = ListingDuplicate.query.filter_by(
+        listing_id=listing_id, duplicate_of_id=other_id, method=method
+    ).first()
+    if existing:
+        existing.score = score
+    else:
+        db.session.add(ListingDuplicate(
+            listing_id=listing_id, duplicate_of_id=other_id, method=method, score=score
+        ))
+
+
+def rebuild_lsh_index(batch_size: int = 500) -> int:
+    """
+    Заполняет listing_lsh_bucket для всех объявлений по порядку id и
+    записывает найденные пары (каждое объявление сверяется с более ранними).
+    """
+    ListingLSHBucket.query.delete(synchronize_session=False)
+    db.session.commit()
+
+    last_id, found = 0, 0
+    while True:
+        batch = (
+            Listing.query
+            .filter(Listing.id > last_id)
+            .order_by(Listing.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not batch:
+            break
+        for listing in batch:
+            for other, score in find_duplicates(listing.title, listing.description, exclude_id=listing.id):
+                record_duplicate(listing.id, other.id, "minhash", score)
+                found += 1
+            index_listing_shingles(listing)
+            db.session.flush()
+        db.session.commit()
+        last_id = batch[-1].id
+    return found
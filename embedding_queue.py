@@ -0,0 +1,141 @@
+# embedding_queue.py
+# Фоновый пересчёт эмбеддингов объявлений после create/edit:
+# маршруты только ставят id в очередь (после commit), фоновый поток забирает
+# их пачками, считает эмбеддинги одним вызовом get_embeddings, пишет в базу
+# и обновляет in-memory индекс процесса и таблицу похожих объявлений.
+# Индексы остальных воркеров подхватывают запись по embedding_updated_at
+# (vector_index.poll_embedding_updates). Очередь живёт в памяти воркера:
+# если процесс упал, build_embeddings.py догонит пропущенное по хэшу текста.
+import queue
+import threading
+import time
+from datetime import datetime
+
+from models import db, Listing, pack_embedding
+from ai_utils import (
+    get_embeddings, embedding_text, embedding_text_hash, EMBED_MODEL, EMBED_DTYPE
+)
+from vector_index import ensure_listing_index
+from similar_listings import refresh_similar_listings
+from duplicates import record_duplicate, DUPLICATE_EMBEDDING_SCORE
+
+
+def needs_embedding(text_hash: str, stored_hash: str, model: str) -> bool:
+    return text_hash != stored_hash or model != EMBED_MODEL
+
+
+def save_embeddings(batch, vectors):
+    """batch — [(listing_id, text, text_hash)], vectors — в том же порядке."""
+    updated_at = datetime.utcnow()
+    db.session.bulk_update_mappings(Listing, [
+        {
+            "id": listing_id,
+            "embedding_blob": pack_embedding(vector, EMBED_DTYPE),
+            "embedding_dtype": EMBED_DTYPE,
+            "embedding_dim": len(vector),
+            "embedding_model": EMBED_MODEL,
+            "embedding_text_hash": text_hash,
+            "embedding_updated_at": updated_at,
+        }
+        for (listing_id, _, text_hash), vector in zip(batch, vectors)
+    ])
+    db.session.commit()
+
+
+class ListingEmbeddingQueue:
+    """
+    enqueue(listing_id) ничего не ждёт; поток собирает id в пределах window_ms
+    (но не больше max_batch), повторы одного id в очереди схлопываются.
+    """
+
+    def __init__(self, window_ms: float = 500, max_batch: int = 100):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.enabled = True
+        self.app = None
+        self._queue = queue.Queue()
+        self._queued = set()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get("EMBED_ON_WRITE", self.enabled)
+
+    def enqueue(self, listing_id: int):
+        if not self.enabled or self.app is None:
+            return
+        with self._lock:
+            if listing_id in self._queued:
+                return
+            self._queued.add(listing_id)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="listing-embeddings", daemon=True
+                )
+                self._thread.start()
+        self._queue.put(listing_id)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            with self._lock:
+                self._queued.difference_update(batch)
+            with self.app.app_context():
+                try:
+                    self.process(batch)
+                except Exception as e:
+                    db.session.rollback()
+                    self.app.logger.warning(
+                        "Embedding %d listings failed: %s: %s", len(batch), type(e).__name__, e
+                    )
+
+    def process(self, listing_ids: list) -> int:
+        """Считает и сохраняет эмбеддинги для listing_ids, у которых изменился текст."""
+        rows = db.session.query(
+            Listing.id, Listing.title, Listing.city, Listing.description,
+            Listing.embedding_text_hash, Listing.embedding_model,
+            Listing.price, Listing.type, Listing.city_key
+        ).filter(Listing.id.in_(listing_ids)).all()
+
+        pending, attributes = [], {}
+        for row in rows:
+            text = embedding_text(row.title, row.city, row.description)
+            text_hash = embedding_text_hash(text)
+            if needs_embedding(text_hash, row.embedding_text_hash, row.embedding_model):
+                pending.append((row.id, text, text_hash))
+                attributes[row.id] = {"price": row.price, "type": row.type, "city_key": row.city_key}
+        if not pending:
+            return 0
+
+        vectors = get_embeddings([text for _, text, _ in pending])
+        save_embeddings(pending, vectors)
+
+        # если индекс только что загружен, новые эмбеддинги в нём уже есть — upsert их просто перезапишет
+        index = ensure_listing_index(EMBED_MODEL)
+        for (listing_id, _, _), vector in zip(pending, vectors):
+            index.upsert(listing_id, vector, attributes[listing_id])
+        refresh_similar_listings(
+            {listing_id: vector for (listing_id, _, _), vector in zip(pending, vectors)}, index
+        )
+
+        # почти одинаковые эмбеддинги — в отчёт о дубликатах (дополняет MinHash-проверку)
+        for (listing_id, _, _), vector in zip(pending, vectors):
+            for other_id, score in index.search(vector, 3):
+                if other_id != listing_id and score >= DUPLICATE_EMBEDDING_SCORE:
+                    record_duplicate(listing_id, other_id, "embedding", score)
+        db.session.commit()
+        return len(pending)
+
+
+embedding_queue = ListingEmbeddingQueue()
@@ -0,0 +1,155 @@
+# file_sweeper.py
+# Отложенное удаление файлов из UPLOAD_FOLDER. Маршруты не трогают диск:
+# bury() кладёт надгробия (FileTombstone) в ту же транзакцию, что и удаление
+# строк, а фоновый поток удаляет файлы после commit. Откат транзакции — файлы
+# на месте; падение процесса после commit — надгробия дождутся следующего
+# прохода (поток запускается первым wake(), дальше просыпается по wake() и раз
+# в SWEEP_INTERVAL секунд; gc_uploads.py тоже начинает с sweep()).
+# Потоков столько же, сколько воркеров: каждое надгробие сначала забирается (claim).
+# Blob-ы из blob_store удаляются, только если на них не осталось ссылок.
+# Файлы, о которых база не знает совсем, находит gc_uploads.py.
+import os
+import shutil
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_, update
+
+from models import db, FileTombstone
+from blob_store import blob_store, blob_digest
+
+SWEEP_INTERVAL = int(os.getenv("SWEEP_INTERVAL", 300))
+CLAIM_TIMEOUT = timedelta(minutes=10)
+TRASH_DIR = ".trash"
+
+
+def bury(paths):
+    """Надгробия для путей внутри UPLOAD_FOLDER (файлов или папок) в текущей транзакции."""
+    db.session.add_all([FileTombstone(path=path) for path in dict.fromkeys(paths)])
+
+
+def bury_dir(root: str, path: str):
+    """
+    Для папок, имя которых может достаться новой строке (deals/<id>: SQLite
+    выдаёт id удалённой последней строки заново): папка сразу переименовывается
+    в .trash/<uuid>/<path> (одна операция rename), надгробие ставится на
+    .trash/<uuid>. Вызывать прямо перед commit; если commit не удался —
+    restore_dirs(). Возвращает (откуда, куда) или None, если папки нет.
+    """
+    src = os.path.join(root, path)
+    if not os.path.isdir(src):
+        return None
+    trash = f"{TRASH_DIR}/{uuid.uuid4().hex}"
+    dst = os.path.join(root, trash, path)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    os.rename(src, dst)
+    bury([trash])
+    return src, dst
+
+
+def restore_dirs(moved):
+    """Возвращает папки, переименованные bury_dir(), на место (после rollback)."""
+    for src, dst in reversed([item for item in moved if item]):
+        os.rename(dst, src)
+        parent = os.path.dirname(dst)
+        while os.path.basename(parent) != TRASH_DIR and not os.listdir(parent):
+            os.rmdir(parent)  # пустая .trash/<uuid>/...
+            parent = os.path.dirname(parent)
+
+
+def remove_path(root: str, path: str):
+    root = os.path.abspath(root)
+    full = os.path.abspath(os.path.join(root, path))
+    if not full.startswith(root + os.sep):
+        return  # только внутри UPLOAD_FOLDER
+    if os.path.isdir(full):
+        shutil.rmtree(full)
+    else:
+        try:
+            os.remove(full)
+        except FileNotFoundError:
+            pass
+
+
+def claim(tombstone_id: int) -> bool:
+    """
+    Забирает надгробие себе (UPDATE ... WHERE claimed_at IS NULL): воркеров несколько,
+    и каждый запускает свой поток. Надгробие упавшего воркера освобождается через CLAIM_TIMEOUT.
+    """
+    now = datetime.utcnow()
+    claimed = db.session.execute(
+        update(FileTombstone)
+        .where(
+            FileTombstone.id == tombstone_id,
+            or_(FileTombstone.claimed_at.is_(None), FileTombstone.claimed_at < now - CLAIM_TIMEOUT)
+        )
+        .values(claimed_at=now)
+    ).rowcount
+    db.session.commit()
+    return bool(claimed)
+
+
+def sweep(root: str, batch_size: int = 200) -> int:
+    """Удаляет файлы по надгробиям пачками; каждое надгробие снимается вместе с файлом."""
+    removed = 0
+    while True:
+        stale = datetime.utcnow() - CLAIM_TIMEOUT
+        ids = [
+            tombstone_id for (tombstone_id,) in
+            db.session.query(FileTombstone.id)
+            .filter(or_(FileTombstone.claimed_at.is_(None), FileTombstone.claimed_at < stale))
+            .order_by(FileTombstone.id)
+            .limit(batch_size)
+        ]
+        if not ids:
+            return removed
+        for tombstone_id in ids:
+            if not claim(tombstone_id):
+                continue
+            tombstone = db.session.get(FileTombstone, tombstone_id)
+            if tombstone is None:
+                continue
+            if blob_digest(tombstone.path):
+                blob_store.sweep(tombstone.path)
+            else:
+                remove_path(root, tombstone.path)
+            db.session.delete(tombstone)
+            db.session.commit()
+            removed += 1
+
+
+class FileSweeper:
+    def __init__(self, interval: float = SWEEP_INTERVAL):
+        self.interval = interval
+        self.app = None
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+
+    def wake(self):
+        """Вызывать после commit с надгробиями."""
+        if self.app is None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="file-sweeper", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            with self.app.app_context():
+                try:
+                    sweep(self.app.config["UPLOAD_FOLDER"])
+                except Exception as e:
+                    db.session.rollback()
+                    self.app.logger.warning("File sweep failed: %s: %s", type(e).__name__, e)
+
+
+file_sweeper = FileSweeper()
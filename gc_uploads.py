@@ -0,0 +1,147 @@
+# gc_uploads.py
+# Периодическая сверка UPLOAD_FOLDER с базой (например, из cron):
+# 1) доделывает удаления по оставшимся надгробиям (file_sweeper.sweep);
+# 2) пересчитывает blob.refcount по listing_image, а blob-ам без ссылок
+#    ставит надгробия;
+# 3) файлы, на которые не ссылаются ListingImage, DealDocument, DealContract*
+#    и blob, удаляются через надгробия. Файлы моложе GC_MIN_AGE секунд не
+#    трогаем — это могут быть загрузки, чья транзакция ещё не закончилась;
+# 4) из папок в .trash без надгробий (процесс упал между rename и commit в
+#    file_sweeper.bury_dir) возвращает на место файлы, на которые ещё
+#    ссылаются строки, остальное удаляет;
+# 5) печатает строки, чьих файлов нет на диске.
+#
+#   python gc_uploads.py              # GC_MIN_AGE=3600
+#   python gc_uploads.py --dry-run    # только показать
+import os
+import sys
+import time
+
+from sqlalchemy import func, select, update
+
+from app import app, db
+from models import ListingImage, Blob, DealDocument, DealContract, DealContractSigned, FileTombstone
+from blob_store import blob_paths
+from file_sweeper import TRASH_DIR, bury, sweep
+
+MIN_AGE = int(os.getenv("GC_MIN_AGE", 3600))
+DRY_RUN = "--dry-run" in sys.argv
+
+
+def deal_file(filename: str) -> str:
+    """Файлы сделок хранятся как "uploads/deals/..." (от static/), переводим в путь внутри UPLOAD_FOLDER."""
+    return filename[len("uploads/"):] if filename.startswith("uploads/") else filename
+
+
+def referenced_paths():
+    """
+    (required, referenced): required — файлы, на которые прямо ссылаются строки
+    (их отсутствие — ошибка), referenced — всё, что нельзя удалять, включая
+    варианты фото (у blob-ов — все возможные имена вариантов).
+    """
+    required, referenced = set(), set()
+    for filename, variants in db.session.query(ListingImage.filename, ListingImage.variants):
+        required.add(filename)
+        for entry in (variants or {}).values():
+            referenced.update(value for key, value in entry.items() if key != "width")
+    for (filename,) in db.session.query(Blob.filename).filter(Blob.refcount > 0):
+        referenced.update(blob_paths(filename))
+    for (filename,) in db.session.query(DealDocument.filename):
+        required.add(deal_file(filename))
+    for (filename,) in db.session.query(DealContract.unsigned_filename):
+        required.add(deal_file(filename))
+    for (filename,) in db.session.query(DealContractSigned.filename):
+        required.add(deal_file(filename))
+    return required, referenced | required
+
+
+def fix_refcounts() -> int:
+    """Один UPDATE: refcount = число ListingImage с этим файлом, где они расходятся."""
+    actual = (
+        select(func.count(ListingImage.id))
+        .where(ListingImage.filename == Blob.filename)
+        .scalar_subquery()
+    )
+    fixed = db.session.execute(
+        update(Blob).where(Blob.refcount != actual).values(refcount=actual)
+    ).rowcount
+    buried = {path for (path,) in db.session.query(FileTombstone.path)}
+    bury([
+        filename for (filename,) in db.session.query(Blob.filename).filter(Blob.refcount <= 0)
+        if filename not in buried
+    ])
+    return fixed
+
+
+def trash_entries(root: str, cutoff: float):
+    """Папки .trash/<uuid> старше cutoff без надгробия."""
+    trash_root = os.path.join(root, TRASH_DIR)
+    if not os.path.isdir(trash_root):
+        return []
+    buried = {path for (path,) in db.session.query(FileTombstone.path).filter(FileTombstone.path.like(f"{TRASH_DIR}/%"))}
+    return [
+        f"{TRASH_DIR}/{name}" for name in os.listdir(trash_root)
+        if f"{TRASH_DIR}/{name}" not in buried and os.path.getmtime(os.path.join(trash_root, name)) < cutoff
+    ]
+
+
+def restore_trash(root: str, entries, required) -> int:
+    """
+    Файлы из .trash/<uuid>/<путь>, на которые ещё ссылаются строки, возвращает
+    на <путь> (если там пусто), остальное содержимое корзины хоронит.
+    """
+    restored = 0
+    for trash in entries:
+        for dirpath, _, files in os.walk(os.path.join(root, trash)):
+            for name in files:
+                path = os.path.relpath(os.path.join(dirpath, name), os.path.join(root, trash)).replace(os.sep, "/")
+                target = os.path.join(root, path)
+                if path in required and not os.path.exists(target):
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    os.rename(os.path.join(dirpath, name), target)
+                    restored += 1
+    bury(entries)
+    db.session.commit()
+    return restored
+
+
+with app.app_context():
+    root = app.config["UPLOAD_FOLDER"]
+    if not DRY_RUN:
+        print(f"Swept {sweep(root)} pending tombstones")
+        print(f"Fixed refcounts of {fix_refcounts()} blobs")
+        db.session.commit()
+
+    required, referenced = referenced_paths()
+    cutoff = time.time() - MIN_AGE
+    trash = trash_entries(root, cutoff)
+    if DRY_RUN:
+        for entry in trash:
+            print(f"Trash: {entry}")
+    else:
+        print(f"Restored {restore_trash(root, trash, required)} files from {TRASH_DIR}")
+        sweep(root)
+
+    orphans = []
+    for dirpath, dirnames, files in os.walk(root):
+        if dirpath == root and TRASH_DIR in dirnames:
+            dirnames.remove(TRASH_DIR)  # корзину разбирают trash_entries/restore_trash
+        for name in files:
+            path = os.path.relpath(os.path.join(dirpath, name), root).replace(os.sep, "/")
+            if path not in referenced and os.path.getmtime(os.path.join(dirpath, name)) < cutoff:
+                orphans.append(path)
+
+    missing = sorted(path for path in required if not os.path.exists(os.path.join(root, path)))
+    for path in missing:
+        print(f"Missing: {path}")
+
+    if DRY_RUN:
+        for path in orphans:
+            print(f"Orphan: {path}")
+    else:
+        for start in range(0, len(orphans), 500):
+            bury(orphans[start:start + 500])
+            db.session.commit()
+        sweep(root)
+
+print(f"Done! {len(orphans)} orphaned files{' found' if DRY_RUN else ' removed'}, {len(missing)} missing.")
@@ -0,0 +1,207 @@
+# image_metadata.py
+# Удаление метаданных из загруженных фото без перекодирования: оригиналы
+# отдаются публично (пока нет вариантов и как fallback в _picture.html),
+# а EXIF телефонных снимков содержит GPS, модель устройства и превью.
+# Сегменты/чанки с метаданными вырезаются, пиксельные данные копируются
+# байт в байт; sha256 считается уже по очищенному файлу, так что
+# одинаковые повторные загрузки по-прежнему дедуплицируются в blob store.
+#   JPEG — APP1 (EXIF, XMP), APP13 (IPTC), COM, MPF и всё после EOI;
+#   PNG  — eXIf, tEXt, zTXt, iTXt, tIME;
+#   WebP — EXIF и XMP (с флагами VP8X и размером RIFF).
+# Ориентация снимка при этом остаётся: вместо EXIF пишется минимальный
+# EXIF из одного тега Orientation.
+import hashlib
+import os
+import struct
+import tempfile
+import zlib
+
+from upload_sink import CHUNK_SIZE, UploadResult
+
+_JPEG_APP1_DROP = (b"Exif\0", b"http://ns.adobe.com/xap/1.0/\0", b"http://ns.adobe.com/xmp/extension/\0")
+_PNG_DROP = {b"eXIf", b"tEXt", b"zTXt", b"iTXt", b"tIME"}
+_WEBP_DROP = {b"EXIF", b"XMP "}
+_ORIENTATION_TAG = 0x0112
+
+
+class _Writer:
+    """Временный файл рядом с исходным, sha256 и размер по ходу записи."""
+
+    def __init__(self, path: str):
+        self.file = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=".upload-", delete=False)
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes):
+        self.file.write(data)
+        self.digest.update(data)
+        self.size += len(data)
+
+
+def _read_exact(f, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("Unexpected end of image")
+    return data
+
+
+def _exif_orientation(tiff: bytes):
+    """Значение тега Orientation из IFD0 EXIF (TIFF-структура) или None."""
+    if tiff.startswith(b"Exif\0\0"):
+        tiff = tiff[6:]
+    if tiff[:4] not in (b"II*\0", b"MM\0*"):
+        return None
+    order = "<" if tiff[:2] == b"II" else ">"
+    try:
+        (ifd,) = struct.unpack_from(order + "I", tiff, 4)
+        (count,) = struct.unpack_from(order + "H", tiff, ifd)
+        for i in range(count):
+            tag, kind, _, value = struct.unpack_from(order + "HHIH", tiff, ifd + 2 + 12 * i)
+            if tag == _ORIENTATION_TAG and kind == 3:
+                return value if value != 1 else None
+    except struct.error:
+        return None
+    return None
+
+
+def _orientation_exif(orientation: int) -> bytes:
+    """EXIF с единственным тегом Orientation (ImageOps.exif_transpose и браузеры его учитывают)."""
+    return b"MM\0*" + struct.pack(">IHHHIHHI", 8, 1, _ORIENTATION_TAG, 3, 1, orientation, 0, 0)
+
+
+def _strip_jpeg(f, out: _Writer) -> bool:
+    if _read_exact(f, 2) != b"\xff\xd8":
+        raise ValueError("Not a JPEG")
+    out.write(b"\xff\xd8")
+    stripped = False
+    while True:
+        if _read_exact(f, 1) != b"\xff":
+            raise ValueError("Bad JPEG marker")
+        marker = _read_exact(f, 1)
+        while marker == b"\xff":  # байты-заполнители
+            marker = _read_exact(f, 1)
+        if marker == b"\xd9":
+            out.write(b"\xff\xd9")
+            break
+        (length,) = struct.unpack(">H", _read_exact(f, 2))
+        payload = _read_exact(f, length - 2)
+        drop = (
+            (marker == b"\xe1" and payload.startswith(_JPEG_APP1_DROP))
+            or (marker == b"\xe2" and payload.startswith(b"MPF\0"))
+            or marker in (b"\xed", b"\xfe")
+        )
+        if drop:
+            orientation = _exif_orientation(payload) if payload.startswith(b"Exif\0\0") else None
+            if orientation:
+                kept = b"Exif\0\0" + _orientation_exif(orientation)
+                stripped = stripped or payload != kept
+                out.write(b"\xff\xe1" + struct.pack(">H", len(kept) + 2) + kept)
+            else:
+                stripped = True
+            continue
+        out.write(b"\xff" + marker + struct.pack(">H", length) + payload)
+        if marker == b"\xda":
+            # сжатые данные копируются как есть до EOI (в них 0xFF всегда экранирован,
+            # так что FFD9 — только настоящий конец); всё, что после, отбрасывается
+            tail = b""
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                data = tail + chunk
+                end = data.find(b"\xff\xd9")
+                if end != -1:
+                    out.write(data[:end + 2])
+                    stripped = stripped or bool(data[end + 2:]) or bool(f.read(1))
+                    return stripped
+                out.write(data[:-1])
+                tail = data[-1:]
+            raise ValueError("JPEG without EOI")
+    return stripped or bool(f.read(1))
+
+
+def _strip_png(f, out: _Writer) -> bool:
+    signature = _read_exact(f, 8)
+    if signature != b"\x89PNG\r\n\x1a\n":
+        raise ValueError("Not a PNG")
+    out.write(signature)
+    stripped = False
+    while True:
+        header = _read_exact(f, 8)
+        (length,), kind = struct.unpack(">I", header[:4]), header[4:]
+        if kind in _PNG_DROP:
+            data = _read_exact(f, length + 4)[:-4]
+            orientation = _exif_orientation(data) if kind == b"eXIf" else None
+            if orientation:
+                kept = _orientation_exif(orientation)
+                stripped = stripped or data != kept
+                out.write(struct.pack(">I", len(kept)) + b"eXIf" + kept + struct.pack(">I", zlib.crc32(b"eXIf" + kept)))
+            else:
+                stripped = True
+            continue
+        out.write(header)
+        remaining = length + 4  # данные + CRC
+        while remaining:
+            chunk = _read_exact(f, min(CHUNK_SIZE, remaining))
+            out.write(chunk)
+            remaining -= len(chunk)
+        if kind == b"IEND":
+            return stripped or bool(f.read(1))
+
+
+def _strip_webp(f, out: _Writer) -> bool:
+    header = _read_exact(f, 12)
+    if header[:4] != b"RIFF" or header[8:] != b"WEBP":
+        raise ValueError("Not a WebP")
+    chunks, stripped = [], False
+    while True:
+        chunk_header = f.read(8)
+        if len(chunk_header) < 8:
+            break
+        kind, (size,) = chunk_header[:4], struct.unpack("<I", chunk_header[4:])
+        data = _read_exact(f, size + (size & 1))  # чанки выровнены до чётной длины
+        if kind in _WEBP_DROP:
+            orientation = _exif_orientation(data[:size]) if kind == b"EXIF" else None
+            if orientation:
+                kept = _orientation_exif(orientation)
+                stripped = stripped or data[:size] != kept
+                chunks.append(b"EXIF" + struct.pack("<I", len(kept)) + kept)
+            else:
+                stripped = True
+            continue
+        chunks.append(chunk_header + data)
+    if not stripped:
+        return False
+    has_exif = any(chunk.startswith(b"EXIF") for chunk in chunks)
+    for i, chunk in enumerate(chunks):
+        if chunk.startswith(b"VP8X"):
+            # флаги EXIF (0x08) и XMP (0x04)
+            flags = (chunk[8] & ~0x0C) | (0x08 if has_exif else 0)
+            chunks[i] = chunk[:8] + bytes([flags]) + chunk[9:]
+    body = b"".join(chunks)
+    out.write(b"RIFF" + struct.pack("<I", len(body) + 4) + b"WEBP" + body)
+    return True
+
+
+_STRIPPERS = {"image/jpeg": _strip_jpeg, "image/png": _strip_png, "image/webp": _strip_webp}
+
+
+def strip_metadata(path: str, mime: str):
+    """
+    Вырезает метаданные из файла path на месте. Возвращает UploadResult
+    очищенного файла или None, если вырезать было нечего (файл не тронут).
+    ValueError — структура файла не разбирается.
+    """
+    strip = _STRIPPERS.get(mime)
+    if strip is None:
+        return None
+    out = _Writer(path)
+    try:
+        with open(path, "rb") as f, out.file:
+            stripped = strip(f, out)
+        if not stripped:
+            os.remove(out.file.name)
+            return None
+        os.replace(out.file.name, path)
+    except BaseException:
+        if os.path.exists(out.file.name):
+            os.remove(out.file.name)
+        raise
+    return UploadResult(out.digest.hexdigest(), out.size, mime)
@@ -0,0 +1,193 @@
+# image_variants.py
+# Уменьшенные копии фото объявлений: для каждого загруженного файла в
+# UPLOAD_FOLDER/variants/ пишутся card (480px) и detail (1280px) в JPEG и WebP,
+# а их имена — в ListingImage.variants. Генерация идёт в пуле потоков вне
+# запроса; пока вариантов нет (или не установлен Pillow), шаблоны показывают оригинал.
+# Для уже загруженных фото — build_image_variants.py. Тот же пул принимает
+# новые загрузки (stage_listing_images в app.py), чтобы запрос с 20 фото ждал
+# самое долгое из них, а не сумму.
+import itertools
+import os
+import queue
+import threading
+from concurrent.futures import Future, wait
+
+from flask import current_app
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow необязателен
+    Image = ImageOps = None
+
+from models import db, ListingImage
+
+VARIANT_DIR = "variants"
+VARIANT_WIDTHS = {"card": 480, "detail": 1280}
+VARIANT_FORMATS = {
+    # формат Pillow -> (расширение, параметры сохранения)
+    "jpeg": ("jpg", {"quality": 82, "optimize": True, "progressive": True}),
+    "webp": ("webp", {"quality": 80, "method": 4}),
+}
+
+
+def variants_available() -> bool:
+    return Image is not None
+
+
+def is_image(path: str) -> bool:
+    """Файл открывается и проходит verify() в Pillow. Без Pillow проверка пропускается."""
+    if Image is None:
+        return True
+    try:
+        with Image.open(path) as image:
+            image.verify()
+        return True
+    except Exception:  # Pillow бросает на битых файлах что угодно, от OSError до SyntaxError
+        return False
+
+
+def variant_filename(filename: str, size: str, ext: str) -> str:
+    stem = os.path.splitext(filename)[0]
+    return f"{VARIANT_DIR}/{stem}_{size}.{ext}"
+
+
+def generate_variants(upload_folder: str, filename: str) -> dict:
+    """
+    Пишет варианты файла и возвращает
+    {"card": {"width": 480, "jpeg": "variants/..jpg", "webp": "variants/..webp"}, "detail": {...}}.
+    Фото уже меньше нужной ширины только перекодируется, без увеличения.
+    """
+    os.makedirs(os.path.dirname(os.path.join(upload_folder, variant_filename(filename, "card", "jpg"))), exist_ok=True)
+    max_width = max(VARIANT_WIDTHS.values())
+
+    with Image.open(os.path.join(upload_folder, filename)) as original:
+        # для JPEG декодируем сразу в уменьшенном масштабе (DCT scaling)
+        original.draft("RGB", (max_width, max_width))
+        image = ImageOps.exif_transpose(original)
+        if image.mode != "RGB":
+            # прозрачность (PNG, GIF) — на белый фон
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, "white")
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+
+        variants, entry = {}, None
+        for size, width in sorted(VARIANT_WIDTHS.items(), key=lambda item: -item[1]):
+            if image.width > width:
+                image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+            elif entry is not None:
+                # фото уже не больше предыдущего размера — те же файлы
+                variants[size] = entry
+                continue
+            entry = {"width": image.width}
+            for fmt, (ext, options) in VARIANT_FORMATS.items():
+                name = variant_filename(filename, size, ext)
+                image.save(os.path.join(upload_folder, name), fmt.upper(), **options)
+                entry[fmt] = name
+            variants[size] = entry
+    return variants
+
+
+def remove_variant_files(upload_folder: str, variants: dict):
+    for entry in (variants or {}).values():
+        for fmt in VARIANT_FORMATS:
+            if fmt in entry:
+                try:
+                    os.remove(os.path.join(upload_folder, entry[fmt]))
+                except FileNotFoundError:
+                    pass
+
+
+def process_image(image_id: int, upload_folder: str) -> bool:
+    """Генерирует варианты для одной ListingImage и сохраняет их. False — фото уже удалено."""
+    img = db.session.get(ListingImage, image_id)
+    if img is None:
+        return False
+
+    # то же фото (blob store) уже обработано для другого объявления
+    shared = ListingImage.query.filter(
+        ListingImage.filename == img.filename, ListingImage.id != img.id, ListingImage.variants.isnot(None)
+    ).first()
+    if shared is not None and shared.variants:
+        img.variants = shared.variants
+        db.session.commit()
+        return True
+
+    try:
+        img.variants = generate_variants(upload_folder, img.filename)
+    except (OSError, ValueError) as e:
+        # файла нет или это не картинка — помечаем, чтобы не пробовать снова
+        img.variants = {}
+        current_app.logger.warning(
+            "Image variants for %s (%s) failed: %s: %s", image_id, img.filename, type(e).__name__, e
+        )
+    db.session.commit()
+    return True
+
+
+class ImageVariantPool:
+    """
+    Общий на приложение пул потоков для работы с фото (Pillow и hashlib отпускают
+    GIL): приём загрузок (run) и генерация вариантов (submit). Один пул на процесс —
+    одновременные загрузки не запускают больше IMAGE_WORKERS потоков.
+    Очередь с приоритетом: приём загрузки (его ждёт запрос) обгоняет фоновые варианты.
+    """
+
+    INGEST, BACKGROUND = 0, 1
+
+    def __init__(self, workers: int = 2):
+        self.workers = workers
+        self.app = None
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config.get("IMAGE_WORKERS", self.workers)
+
+    def _put(self, priority: int, fn, *args) -> Future:
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._work, name=f"image-pool-{len(self._threads)}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+        future = Future()
+        self._queue.put((priority, next(self._seq), future, fn, args))
+        return future
+
+    def _work(self):
+        while True:
+            _, _, future, fn, args = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def run(self, fn, items) -> list:
+        """fn(item) для всех items параллельно; ждёт все и возвращает завершённые future по порядку."""
+        futures = [self._put(self.INGEST, fn, item) for item in items]
+        wait(futures)
+        return futures
+
+    def submit(self, image_ids):
+        if not variants_available() or self.app is None:
+            return
+        for image_id in image_ids:
+            self._put(self.BACKGROUND, self._run, image_id)
+
+    def _run(self, image_id: int):
+        with self.app.app_context():
+            try:
+                process_image(image_id, self.app.config["UPLOAD_FOLDER"])
+            except Exception as e:
+                db.session.rollback()
+                self.app.logger.warning("Image variants for %s failed: %s: %s", image_id, type(e).__name__, e)
+
+
+image_variants = ImageVariantPool()
@@ -0,0 +1,218 @@
+# migrate_db.py
+# db.create_all() создаёт только отсутствующие таблицы и не меняет существующие,
+# поэтому новые колонки и индексы для уже работающей базы добавляем здесь,
+# вместе с пересчётом денормализованных данных.
+# Скрипт идемпотентный: можно запускать после каждого обновления.
+import hashlib
+import os
+import shutil
+
+from sqlalchemy import inspect, text, select, update, func
+from sqlalchemy.orm import undefer
+
+from app import app, db
+from models import Listing, ListingImage, ReviewListing, Blob, normalize_city_key
+from search_utils import rebuild_fulltext_index
+from blob_store import blob_store, blob_digest, blob_filename
+from image_variants import remove_variant_files
+from duplicates import rebuild_lsh_index
+from ai_utils import embedding_text, embedding_text_hash
+
+
+def add_missing_columns():
+    """ALTER TABLE ... ADD COLUMN для колонок, которые есть в models.py, но нет в базе."""
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    dialect = db.engine.dialect
+    quote = dialect.identifier_preparer.quote
+
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+
+            present = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in present:
+                    continue
+
+                ddl = (
+                    f"ALTER TABLE {quote(table.name)} "
+                    f"ADD COLUMN {quote(column.name)} {column.type.compile(dialect=dialect)}"
+                )
+                if column.server_default is not None:
+                    default = column.server_default.arg
+                    ddl += f" DEFAULT {getattr(default, 'text', default)}"
+                    if not column.nullable:
+                        ddl += " NOT NULL"
+
+                conn.execute(text(ddl))
+                print(f"Added column {table.name}.{column.name}")
+
+
+def create_missing_indexes():
+    """
+    CREATE INDEX для индексов из models.py, которых ещё нет в базе
+    (create_all пропускает существующие таблицы вместе с их индексами).
+    """
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    created = 0
+
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+
+            present = {ix["name"] for ix in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in present:
+                    continue
+                index.create(bind=conn)
+                created += 1
+                print(f"Created index {index.name}")
+
+        if created:
+            # обновляем статистику, чтобы планировщик сразу начал использовать новые индексы
+            conn.execute(text("ANALYZE"))
+
+
+def backfill_rating_aggregates():
+    """Пересчитывает Listing.review_count / rating_sum по таблице review_listing."""
+    count_q = (
+        select(func.count(ReviewListing.id))
+        .where(ReviewListing.listing_id == Listing.id)
+        .scalar_subquery()
+    )
+    sum_q = (
+        select(func.coalesce(func.sum(ReviewListing.rating), 0))
+        .where(ReviewListing.listing_id == Listing.id)
+        .scalar_subquery()
+    )
+    db.session.execute(update(Listing).values(review_count=count_q, rating_sum=sum_q))
+    db.session.commit()
+    print("Rating aggregates rebuilt")
+
+
+def backfill_city_keys(batch_size: int = 1000):
+    """Пересчитывает Listing.city_key (например, после изменения normalize_city_key)."""
+    rows = db.session.query(Listing.id, Listing.city).all()
+    for start in range(0, len(rows), batch_size):
+        db.session.bulk_update_mappings(Listing, [
+            {"id": listing_id, "city_key": normalize_city_key(city)}
+            for listing_id, city in rows[start:start + batch_size]
+        ])
+        db.session.commit()
+    print(f"City keys rebuilt for {len(rows)} listings")
+
+
+# модель, которой build_embeddings.py считал pickled-эмбеддинги
+LEGACY_EMBED_MODEL = "text-embedding-3-large"
+
+
+def convert_pickled_embeddings(dtype: str = None, batch_size: int = 500):
+    """
+    Переносит legacy Listing.embedding (PickleType) в embedding_blob
+    (float32, или float16 через EMBED_DTYPE=float16) и очищает старую колонку.
+    Старый build_embeddings.py считал эмбеддинг по тому же embedding_text(),
+    поэтому хэш текста выставляется сразу — иначе первый запуск
+    build_embeddings.py пересчитал бы весь каталог заново.
+    """
+    dtype = dtype or os.getenv("EMBED_DTYPE", "float32")
+    converted = 0
+    while True:
+        batch = (
+            Listing.query
+            .options(undefer(Listing.embedding))
+            .filter(Listing.embedding.isnot(None))
+            .limit(batch_size)
+            .all()
+        )
+        if not batch:
+            break
+        for listing in batch:
+            if listing.embedding:
+                listing.set_embedding(listing.embedding, LEGACY_EMBED_MODEL, dtype)
+                listing.embedding_text_hash = embedding_text_hash(
+                    embedding_text(listing.title, listing.city, listing.description)
+                )
+            listing.embedding = None
+        db.session.commit()
+        converted += len(batch)
+    print(f"Converted {converted} pickled embeddings to {dtype}")
+
+
+def backfill_embedding_text_hashes(batch_size: int = 1000):
+    """Хэш текста для эмбеддингов, сконвертированных из pickle без него (см. convert_pickled_embeddings)."""
+    rows = db.session.query(Listing.id, Listing.title, Listing.city, Listing.description).filter(
+        Listing.embedding_blob.isnot(None),
+        Listing.embedding_text_hash.is_(None),
+        Listing.embedding_model == LEGACY_EMBED_MODEL
+    ).all()
+    for start in range(0, len(rows), batch_size):
+        db.session.bulk_update_mappings(Listing, [
+            {"id": listing_id, "embedding_text_hash": embedding_text_hash(embedding_text(title, city, description))}
+            for listing_id, title, city, description in rows[start:start + batch_size]
+        ])
+        db.session.commit()
+    print(f"Text hashes set for {len(rows)} converted embeddings")
+
+
+def move_uploads_to_blob_store():
+    """
+    Переносит фото с плоскими именами в blob store: файл переезжает
+    в blobs/ab/cd/<sha256>, одинаковые файлы сливаются в один, ссылки
+    считаются в blob. Варианты сбрасываются — их пересоздаст build_image_variants.py.
+    """
+    root = app.config["UPLOAD_FOLDER"]
+    moved = {}  # старое имя -> (sha256, новое имя, размер)
+
+    for img in ListingImage.query.order_by(ListingImage.id):
+        if blob_digest(img.filename) or not os.path.exists(os.path.join(root, img.filename)):
+            continue
+
+        if img.filename not in moved:
+            path = os.path.join(root, img.filename)
+            h = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    h.update(chunk)
+            digest = h.hexdigest()
+            existing = db.session.get(Blob, digest)
+            filename = existing.filename if existing else blob_filename(digest, os.path.splitext(img.filename)[1].lower())
+            target = os.path.join(root, filename)
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                try:
+                    os.link(path, target)
+                except OSError:
+                    shutil.copy2(path, target)
+            moved[img.filename] = (digest, filename, os.path.getsize(path))
+
+        digest, filename, size = moved[img.filename]
+        remove_variant_files(root, img.variants)
+        img.variants = None
+        blob_store.acquire(digest, filename, size)
+        img.filename = filename
+
+    db.session.commit()
+    # старые имена удаляем только после commit: до него база ссылается на них
+    for old_name in moved:
+        os.remove(os.path.join(root, old_name))
+    print(f"Moved {len(moved)} uploaded files to the blob store")
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        add_missing_columns()
+        create_missing_indexes()
+        backfill_rating_aggregates()
+        backfill_city_keys()
+        rebuild_fulltext_index()
+        print("Full-text index rebuilt")
+        convert_pickled_embeddings()
+        backfill_embedding_text_hashes()
+        print(f"LSH index rebuilt, {rebuild_lsh_index()} duplicate pairs found")
+        move_uploads_to_blob_store()
+
+    print("Done! Database is up to date.")
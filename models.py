@@ -1,8 +1,41 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import validates, deferred
 from datetime import datetime
+import re
+import unicodedata
+
+import numpy as np
 
 db = SQLAlchemy()
 
+# формат хранения эмбеддингов: сырые little-endian байты
+EMBEDDING_DTYPES = {"float32": "<f4", "float16": "<f2"}
+
+
+def pack_embedding(vector, dtype: str = "float32") -> bytes:
+    return np.asarray(vector, dtype=EMBEDDING_DTYPES[dtype]).tobytes()
+
+
+def unpack_embedding(blob: bytes, dtype: str = "float32") -> np.ndarray:
+    return np.frombuffer(blob, dtype=EMBEDDING_DTYPES[dtype]).astype(np.float32)
+
+# DIN 5007-2: умлауты раскрываются, а не наоборот — настоящие "ae"/"oe"/"ue"
+# в названиях (Aue, Soest) при этом не теряются и префиксный поиск не путается
+_UMLAUT_FOLDING = str.maketrans({"ä": "ae", "ö": "oe", "ü": "ue", "ß": "ss"})
+
+
+def normalize_city_key(value: str) -> str:
+    """
+    Ключ города для индексного поиска: casefold + DIN 5007-2, так что
+    "München", "MUENCHEN" и "muenchen " дают одинаковый ключ "muenchen".
+    Остальная диакритика и пунктуация убираются, пробелы схлопываются.
+    """
+    value = unicodedata.normalize("NFC", (value or "").casefold()).translate(_UMLAUT_FOLDING)
+    value = unicodedata.normalize("NFKD", value)
+    value = "".join(ch for ch in value if not unicodedata.combining(ch))
+    return " ".join(re.sub(r"[\W_]+", " ", value).split())
+
+
 # ----------------------------
 # USERS
 # ----------------------------
@@ -29,14 +62,32 @@ class Listing(db.Model):
 
     title = db.Column(db.String(150), nullable=False)
     city = db.Column(db.String(120), nullable=False)
+    # normalize_city_key(city), выставляется автоматически при записи city
+    city_key = db.Column(db.String(120), nullable=True, index=True)
     price = db.Column(db.Integer, nullable=False)
     type = db.Column(db.String(50), nullable=False)
     description = db.Column(db.Text, nullable=True)
 
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-    # Embedding for AI search
-    embedding = db.Column(db.PickleType)
+    # Денормализованные агрегаты отзывов: поддерживаются в add/edit/delete_review,
+    # пересчитываются через migrate_db.py
+    review_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    rating_sum = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+    # Embedding for AI search: float32/float16 байты + модель и размерность.
+    # deferred — карточки и списки эти килобайты не грузят.
+    embedding_blob = deferred(db.Column(db.LargeBinary, nullable=True))
+    embedding_dtype = db.Column(db.String(10), nullable=True)
+    embedding_dim = db.Column(db.Integer, nullable=True)
+    embedding_model = db.Column(db.String(64), nullable=True)
+    # sha256 текста, по которому считан эмбеддинг (ai_utils.embedding_text_hash)
+    embedding_text_hash = db.Column(db.String(64), nullable=True)
+    # когда эмбеддинг записан — по нему воркеры доливают чужие обновления в свой индекс
+    embedding_updated_at = db.Column(db.DateTime, nullable=True)
+
+    # legacy: pickled list[float], migrate_db.py переносит в embedding_blob
+    embedding = deferred(db.Column(db.PickleType))
 
     user = db.relationship("User", backref="listings")
     images = db.relationship(
@@ -47,12 +98,129 @@ class Listing(db.Model):
     )
     reviews = db.relationship("ReviewListing", backref="listing", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        # keyset-пагинация /listings: (sort key, id)
+        db.Index("ix_listing_created_at_id", "created_at", "id"),
+        db.Index("ix_listing_price_id", "price", "id"),
+        # /my-listings
+        db.Index("ix_listing_user_id", "user_id"),
+        # vector_index.poll_embedding_updates
+        db.Index("ix_listing_embedding_updated_at", "embedding_updated_at"),
+    )
+
+    @validates("city")
+    def _sync_city_key(self, key, value):
+        self.city_key = normalize_city_key(value)
+        return value
+
+    def set_embedding(self, vector, model: str, dtype: str = "float32"):
+        self.embedding_blob = pack_embedding(vector, dtype)
+        self.embedding_dtype = dtype
+        self.embedding_dim = len(vector)
+        self.embedding_model = model
+        self.embedding_updated_at = datetime.utcnow()
+
+    @property
+    def embedding_vector(self):
+        """Эмбеддинг как float32 ndarray (или None)."""
+        if not self.embedding_blob:
+            return None
+        return unpack_embedding(self.embedding_blob, self.embedding_dtype or "float32")
+
     @property
     def avg_rating(self):
-        """Средний рейтинг объявления."""
-        if not self.reviews:
+        """Средний рейтинг объявления (без загрузки самих отзывов)."""
+        if not self.review_count:
             return None
-        return sum(r.rating for r in self.reviews) / len(self.reviews)
+        return self.rating_sum / self.review_count
+
+
+class CatalogueState(db.Model):
+    """
+    Одна строка (id=1) с версией каталога. Каждая запись объявлений, фото
+    или отзывов увеличивает version в той же транзакции — по ней
+    инвалидируются закэшированные результаты поиска.
+    """
+    __tablename__ = "catalogue_state"
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+class SimilarListing(db.Model):
+    """
+    Предрассчитанные ближайшие соседи объявления по эмбеддингу
+    (build_similar_listings.py и фоновая очередь эмбеддингов).
+    """
+    __tablename__ = "similar_listing"
+
+    listing_id = db.Column(db.Integer, db.ForeignKey("listing.id"), primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)
+    neighbor_id = db.Column(db.Integer, db.ForeignKey("listing.id"), nullable=False)
+    score = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (
+        # удаление объявления и точечное обновление: WHERE neighbor_id = ?
+        db.Index("ix_similar_listing_neighbor", "neighbor_id"),
+    )
+
+
+class ListingLSHBucket(db.Model):
+    """LSH-бакеты MinHash-подписи объявления (duplicates.py): BANDS строк на объявление."""
+    __tablename__ = "listing_lsh_bucket"
+
+    band = db.Column(db.SmallInteger, primary_key=True)
+    bucket = db.Column(db.BigInteger, primary_key=True)
+    listing_id = db.Column(db.Integer, db.ForeignKey("listing.id"), primary_key=True)
+
+    __table_args__ = (
+        db.Index("ix_listing_lsh_bucket_listing", "listing_id"),
+    )
+
+
+class ListingDuplicate(db.Model):
+    """Найденные почти-дубликаты: listing — более новое объявление, original — более старое."""
+    __tablename__ = "listing_duplicate"
+
+    id = db.Column(db.Integer, primary_key=True)
+    listing_id = db.Column(db.Integer, db.ForeignKey("listing.id"), nullable=False)
+    duplicate_of_id = db.Column(db.Integer, db.ForeignKey("listing.id"), nullable=False)
+    method = db.Column(db.String(16), nullable=False)  # minhash / embedding
+    score = db.Column(db.Float, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    original = db.relationship("Listing", foreign_keys=[duplicate_of_id])
+
+    __table_args__ = (
+        db.Index("ix_listing_duplicate_listing", "listing_id", "duplicate_of_id"),
+        db.Index("ix_listing_duplicate_original", "duplicate_of_id"),
+    )
+
+
+class Blob(db.Model):
+    """Файл в blob store (blob_store.py): sha256 содержимого и число ссылок на него."""
+    __tablename__ = "blob"
+
+    sha256 = db.Column(db.String(64), primary_key=True)
+    filename = db.Column(db.String(255), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class FileTombstone(db.Model):
+    """
+    Файл или папка внутри UPLOAD_FOLDER, которые нужно удалить (file_sweeper.py).
+    Пишется в той же транзакции, что и удаление строк, поэтому при откате
+    файлы остаются на месте, а после commit их удалит фоновый поток.
+    """
+    __tablename__ = "file_tombstone"
+
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(255), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # поток, который удаляет файл, сначала ставит отметку (file_sweeper.claim)
+    claimed_at = db.Column(db.DateTime, nullable=True)
 
 
 class ListingImage(db.Model):
@@ -62,6 +230,17 @@ class ListingImage(db.Model):
 
     sort_order = db.Column(db.Integer, nullable=False, default=0)
 
+    # уменьшенные копии (image_variants.py): {"card": {"width", "jpeg", "webp"}, "detail": {...}};
+    # NULL — ещё не сгенерированы, {} — сгенерировать не удалось
+    variants = db.Column(db.JSON(none_as_null=True), nullable=True)
+
+    __table_args__ = (
+        # обложки и галереи: WHERE listing_id ORDER BY sort_order, id
+        db.Index("ix_listing_image_listing_sort", "listing_id", "sort_order", "id"),
+        # общий blob: process_image ищет готовые варианты, gc_uploads пересчитывает refcount
+        db.Index("ix_listing_image_filename", "filename"),
+    )
+
 # ----------------------------
 # REVIEWS
 # ----------------------------
@@ -77,6 +256,12 @@ class ReviewListing(db.Model):
 
     user = db.relationship("User", backref="listing_reviews")
 
+    __table_args__ = (
+        db.Index("ix_review_listing_listing_created", "listing_id", "created_at"),
+        # /profile/my_reviews и проверка "уже оставил отзыв"
+        db.Index("ix_review_listing_user_listing", "user_id", "listing_id"),
+    )
+
 
 # ----------------------------
 # CHAT
@@ -97,6 +282,13 @@ class MessageThread(db.Model):
     landlord = db.relationship("User", foreign_keys=[landlord_id])
     tenant = db.relationship("User", foreign_keys=[tenant_id])
 
+    __table_args__ = (
+        # /chats: WHERE landlord_id = ? OR tenant_id = ? ORDER BY last_activity
+        db.Index("ix_message_thread_landlord_activity", "landlord_id", "last_activity"),
+        db.Index("ix_message_thread_tenant_activity", "tenant_id", "last_activity"),
+        db.Index("ix_message_thread_listing_tenant", "listing_id", "tenant_id"),
+    )
+
 
 class Message(db.Model):
     __tablename__ = "message"
@@ -110,6 +302,10 @@ class Message(db.Model):
 
     sender = db.relationship("User")
 
+    __table_args__ = (
+        db.Index("ix_message_thread_created", "thread_id", "created_at"),
+    )
+
 
 # ----------------------------
 # DEALS (Relok flow)
@@ -157,6 +353,15 @@ class Deal(db.Model):
     documents = db.relationship("DealDocument", backref="deal", cascade="all, delete-orphan")
     audit = db.relationship("DealAudit", backref="deal", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        # /admin/deals (фильтр по статусу) и /deals (по участнику), всё по updated_at
+        db.Index("ix_deal_status_updated", "status", "updated_at"),
+        db.Index("ix_deal_updated_at", "updated_at"),
+        db.Index("ix_deal_landlord_updated", "landlord_id", "updated_at"),
+        db.Index("ix_deal_tenant_updated", "tenant_id", "updated_at"),
+        db.Index("ix_deal_listing_id", "listing_id"),
+    )
+
     def touch(self):
         self.updated_at = datetime.utcnow()
 
@@ -177,6 +382,11 @@ class DealDocument(db.Model):
 
     filename = db.Column(db.String(255), nullable=False)
 
+    # считаются при записи файла (upload_sink); у старых документов пусто
+    sha256 = db.Column(db.String(64), nullable=True)
+    size = db.Column(db.Integer, nullable=True)
+    mime = db.Column(db.String(100), nullable=True)
+
     # pending / approved / rejected
     status = db.Column(db.String(20), nullable=False, default="pending")
 
@@ -190,6 +400,10 @@ class DealDocument(db.Model):
     uploader = db.relationship("User", foreign_keys=[uploader_id])
     reviewed_by_admin = db.relationship("User", foreign_keys=[reviewed_by_admin_id])
 
+    __table_args__ = (
+        db.Index("ix_deal_document_deal_created", "deal_id", "created_at"),
+    )
+
 
 class DealAudit(db.Model):
     __tablename__ = "deal_audit"
@@ -205,6 +419,10 @@ class DealAudit(db.Model):
 
     actor = db.relationship("User", foreign_keys=[actor_id])
 
+    __table_args__ = (
+        db.Index("ix_deal_audit_deal_created", "deal_id", "created_at"),
+    )
+
 # ----------------------------
 # CONTRACTS (Deal PDF + manual signature)
 # ----------------------------
@@ -0,0 +1,526 @@
+# search_utils.py
+# Фильтры, сортировки и keyset-пагинация для /listings и /api/listings,
+# полнотекстовый поиск (FTS5 / tsvector), версионный кэш результатов,
+# индекс городов для автодополнения.
+import base64
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from bisect import bisect_left
+from datetime import datetime
+
+from sqlalchemy import and_, or_, func, text, select, update, literal, literal_column
+from sqlalchemy.exc import OperationalError
+
+from models import db, Listing, CatalogueState, normalize_city_key
+
+PAGE_SIZE = 24
+
+# sort name -> (колонка, направление); у каждой сортировки есть индекс (колонка, id)
+LISTING_SORTS = {
+    "newest": (Listing.created_at, "desc"),
+    "price_asc": (Listing.price, "asc"),
+    "price_desc": (Listing.price, "desc"),
+}
+DEFAULT_SORT = "newest"
+# сортировка по BM25, доступна только вместе с текстовым запросом q
+RELEVANCE_SORT = "relevance"
+
+
+def parse_listing_filters(args) -> dict:
+    """
+    Нормализует фильтры из query string или JSON-тела
+    (q, city, min_price, max_price, type). Некорректные числа просто игнорируются.
+    """
+    def _str(name):
+        value = args.get(name)
+        return str(value).strip() if value is not None else ""
+
+    def _int(name):
+        value = _str(name)
+        try:
+            return int(value) if value else None
+        except ValueError:
+            return None
+
+    return {
+        "q": _str("q"),
+        "city": _str("city"),
+        "min_price": _int("min_price"),
+        "max_price": _int("max_price"),
+        "type": _str("type"),
+    }
+
+
+def city_key_range(value: str):
+    """
+    Префиксный поиск по city_key как диапазон [key, key_next) —
+    работает по B-tree индексу и в SQLite, и в Postgres (в отличие от ILIKE '%..%').
+    """
+    key = normalize_city_key(value)
+    if not key:
+        return None
+    return key, key[:-1] + chr(ord(key[-1]) + 1)
+
+
+def apply_listing_filters(query, filters: dict):
+    """
+    Накладывает фильтры на Listing.query. Если задан q, объявления ограничиваются
+    совпадениями полнотекстового поиска (подзапрос fts с колонкой rank,
+    по которой сортирует RELEVANCE_SORT).
+    """
+    if filters["q"]:
+        query = apply_fulltext(query, filters["q"])
+
+    key_range = city_key_range(filters["city"])
+    if key_range:
+        low, high = key_range
+        query = query.filter(Listing.city_key >= low, Listing.city_key < high)
+    if filters["min_price"] is not None:
+        query = query.filter(Listing.price >= filters["min_price"])
+    if filters["max_price"] is not None:
+        query = query.filter(Listing.price <= filters["max_price"])
+    if filters["type"]:
+        query = query.filter(Listing.type == filters["type"])
+    return query
+
+
+def parse_sort(value: str, filters: dict = None) -> str:
+    has_query = bool(filters and _query_terms(filters["q"]))
+    if value == RELEVANCE_SORT and has_query:
+        return value
+    if value in LISTING_SORTS:
+        return value
+    return RELEVANCE_SORT if has_query else DEFAULT_SORT
+
+
+def encode_cursor(sort: str, key, last_id: int) -> str:
+    """Непрозрачный токен над (sort key, id) последней строки страницы."""
+    if isinstance(key, datetime):
+        key = key.isoformat()
+    raw = json.dumps([sort, key, last_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(sort: str, token: str):
+    """Возвращает (key, id) или None, если токен пустой, битый или от другой сортировки."""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        cursor_sort, key, last_id = json.loads(raw)
+        if cursor_sort != sort or not isinstance(last_id, int):
+            return None
+        if sort == "newest":
+            key = datetime.fromisoformat(key)
+        elif sort == RELEVANCE_SORT:
+            key = float(key)
+        elif not isinstance(key, int):
+            return None
+        return key, last_id
+    except (ValueError, TypeError):
+        return None
+
+
+def paginate_listings(query, sort: str, cursor: str = "", page_size: int = PAGE_SIZE):
+    """
+    Keyset-пагинация: WHERE (key, id) после курсора ORDER BY key, id LIMIT n+1.
+    Глубокие страницы стоят столько же, сколько первая.
+    Возвращает (items, next_cursor).
+    """
+    if sort == RELEVANCE_SORT:
+        column, direction = FTS_RANK, "asc"
+    else:
+        column, direction = LISTING_SORTS[sort]
+    descending = direction == "desc"
+
+    position = decode_cursor(sort, cursor)
+    if position:
+        key, last_id = position
+        if descending:
+            query = query.filter(or_(column < key, and_(column == key, Listing.id < last_id)))
+        else:
+            query = query.filter(or_(column > key, and_(column == key, Listing.id > last_id)))
+
+    if descending:
+        query = query.order_by(column.desc(), Listing.id.desc())
+    else:
+        query = query.order_by(column.asc(), Listing.id.asc())
+
+    rows = query.add_columns(column).limit(page_size + 1).all()
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last, key = rows[-1]
+        next_cursor = encode_cursor(sort, key, last.id)
+
+    return [item for item, _ in rows], next_cursor
+
+
+# ----------------------------
+# FULL-TEXT SEARCH
+# ----------------------------
+# SQLite: FTS5-таблица listing_fts (rowid = listing.id), BM25 с весами
+# title > city > description; обновляется явно из роутов, пишущих Listing.
+# Postgres: GIN-индекс по to_tsvector(...) — поддерживается самой базой.
+
+# колонка rank из подзапроса apply_fulltext (меньше = релевантнее)
+FTS_RANK = literal_column("fts.rank")
+
+_PG_DOCUMENT = (
+    "to_tsvector('simple', coalesce(listing.title, '') || ' ' || "
+    "coalesce(listing.city, '') || ' ' || coalesce(listing.description, ''))"
+)
+
+_fulltext_available = None
+
+
+def _dialect() -> str:
+    return db.engine.dialect.name
+
+
+def fulltext_available() -> bool:
+    if _fulltext_available is None:
+        ensure_fulltext_index()
+    return _fulltext_available
+
+
+def ensure_fulltext_index():
+    """Создаёт FTS5-таблицу (SQLite) или GIN-индекс (Postgres), если их ещё нет."""
+    global _fulltext_available
+    try:
+        with db.engine.begin() as conn:
+            if _dialect() == "sqlite":
+                conn.execute(text(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS listing_fts USING fts5("
+                    "title, city, description, tokenize = 'unicode61 remove_diacritics 2')"
+                ))
+            elif _dialect() == "postgresql":
+                conn.execute(text(
+                    f"CREATE INDEX IF NOT EXISTS ix_listing_fts ON listing USING gin ({_PG_DOCUMENT})"
+                ))
+            else:
+                _fulltext_available = False
+                return
+        _fulltext_available = True
+    except OperationalError:
+        # SQLite собран без FTS5 — ищем через LIKE
+        _fulltext_available = False
+
+
+def _query_terms(q: str) -> list:
+    return re.findall(r"\w+", q.casefold())
+
+
+def apply_fulltext(query, q: str):
+    terms = _query_terms(q)
+    if not terms:
+        return query
+
+    if not fulltext_available():
+        # без FTS: все слова через ILIKE, релевантность одинаковая
+        fts = select(Listing.id.label("listing_id"), literal(0.0).label("rank")).where(*[
+            or_(
+                Listing.title.ilike(f"%{term}%"),
+                Listing.city.ilike(f"%{term}%"),
+                Listing.description.ilike(f"%{term}%")
+            )
+            for term in terms
+        ]).subquery("fts")
+        return query.join(fts, fts.c.listing_id == Listing.id)
+
+    if _dialect() == "sqlite":
+        # каждое слово как префикс, все слова обязательны
+        match = " ".join(f'"{term}"*' for term in terms)
+        fts = text(
+            "SELECT rowid AS listing_id, bm25(listing_fts, 3.0, 2.0, 1.0) AS rank "
+            "FROM listing_fts WHERE listing_fts MATCH :match"
+        ).bindparams(match=match)
+    else:
+        match = " & ".join(f"{term}:*" for term in terms)
+        fts = text(
+            f"SELECT listing.id AS listing_id, "
+            f"-ts_rank_cd({_PG_DOCUMENT}, to_tsquery('simple', :match)) AS rank "
+            f"FROM listing WHERE {_PG_DOCUMENT} @@ to_tsquery('simple', :match)"
+        ).bindparams(match=match)
+
+    fts = fts.columns(listing_id=db.Integer, rank=db.Float).subquery("fts")
+    return query.join(fts, fts.c.listing_id == Listing.id)
+
+
+def index_listing_text(listing: Listing):
+    """Обновляет запись объявления в FTS-индексе (в текущей транзакции)."""
+    if _dialect() != "sqlite" or not fulltext_available():
+        return
+    db.session.execute(text("DELETE FROM listing_fts WHERE rowid = :id"), {"id": listing.id})
+    db.session.execute(
+        text(
+            "INSERT INTO listing_fts (rowid, title, city, description) "
+            "VALUES (:id, :title, :city, :description)"
+        ),
+        {
+            "id": listing.id,
+            "title": listing.title or "",
+            "city": listing.city or "",
+            "description": listing.description or "",
+        }
+    )
+
+
+def unindex_listing(listing_id: int):
+    if _dialect() != "sqlite" or not fulltext_available():
+        return
+    db.session.execute(text("DELETE FROM listing_fts WHERE rowid = :id"), {"id": listing_id})
+
+
+def rebuild_fulltext_index():
+    """Полная перестройка listing_fts (для migrate_db.py)."""
+    if _dialect() != "sqlite" or not fulltext_available():
+        return
+    db.session.execute(text("DELETE FROM listing_fts"))
+    db.session.execute(text(
+        "INSERT INTO listing_fts (rowid, title, city, description) "
+        "SELECT id, coalesce(title, ''), coalesce(city, ''), coalesce(description, '') FROM listing"
+    ))
+    db.session.commit()
+
+
+# ----------------------------
+# RESULT CACHE
+# ----------------------------
+
+def ensure_catalogue_state():
+    if not db.session.get(CatalogueState, 1):
+        db.session.add(CatalogueState(id=1, version=0))
+        db.session.commit()
+
+
+def bump_catalogue_version():
+    """Вызывать в каждой транзакции, которая пишет Listing / ListingImage / ReviewListing."""
+    db.session.execute(
+        update(CatalogueState)
+        .where(CatalogueState.id == 1)
+        .values(version=CatalogueState.version + 1)
+    )
+
+
+def catalogue_version() -> int:
+    return db.session.query(CatalogueState.version).filter_by(id=1).scalar() or 0
+
+
+class ResultCache:
+    """
+    LRU с TTL в памяти процесса + необязательный общий уровень в SQLite-файле
+    (SEARCH_CACHE_PATH), чтобы воркеры gunicorn делили прогретые результаты.
+    Хранит JSON-сериализуемые значения (списки id); ключи содержат версию
+    каталога, поэтому после любой записи старые записи просто не читаются.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: int = 300, shared_path: str = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.shared_path = shared_path
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def init_app(self, app):
+        self.maxsize = app.config.get("SEARCH_CACHE_SIZE", self.maxsize)
+        self.ttl = app.config.get("SEARCH_CACHE_TTL", self.ttl)
+        self.shared_path = app.config.get("SEARCH_CACHE_PATH") or None
+        if self.shared_path:
+            with self._shared() as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS result_cache "
+                    "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)"
+                )
+
+    def _shared(self):
+        return sqlite3.connect(self.shared_path, timeout=1)
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > now:
+                    self._local.move_to_end(key)
+                    return value
+                del self._local[key]
+
+        if self.shared_path:
+            try:
+                with self._shared() as conn:
+                    row = conn.execute(
+                        "SELECT value, expires FROM result_cache WHERE key = ?", (key,)
+                    ).fetchone()
+            except sqlite3.Error:
+                row = None
+            if row and row[1] > now:
+                value = json.loads(row[0])
+                self._set_local(key, value, row[1])
+                return value
+        return None
+
+    def set(self, key: str, value):
+        expires = time.time() + self.ttl
+        self._set_local(key, value, expires)
+
+        if self.shared_path:
+            try:
+                with self._shared() as conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO result_cache (key, value, expires) VALUES (?, ?, ?)",
+                        (key, json.dumps(value), expires)
+                    )
+                    self._writes += 1
+                    if self._writes % 256 == 0:
+                        conn.execute("DELETE FROM result_cache WHERE expires <= ?", (time.time(),))
+            except sqlite3.Error:
+                pass
+
+    def _set_local(self, key, value, expires):
+        with self._lock:
+            self._local[key] = (expires, value)
+            self._local.move_to_end(key)
+            while len(self._local) > self.maxsize:
+                self._local.popitem(last=False)
+
+
+listing_cache = ResultCache()
+
+
+def cache_key(name: str, **params) -> str:
+    """Ключ кэша: версия каталога + имя выборки + нормализованные параметры."""
+    return json.dumps([catalogue_version(), name, params], sort_keys=True, default=str)
+
+
+def load_listings(ids: list) -> list:
+    """Listing по списку id одним запросом, в порядке ids."""
+    if not ids:
+        return []
+    by_id = {item.id: item for item in Listing.query.filter(Listing.id.in_(ids)).all()}
+    return [by_id[i] for i in ids if i in by_id]
+
+
+def search_listings_page(filters: dict, sort: str, cursor: str = ""):
+    """paginate_listings с кэшированием списка id страницы. Возвращает (items, next_cursor)."""
+    key = cache_key("listings", filters=filters, sort=sort, cursor=cursor)
+    cached = listing_cache.get(key)
+    if cached is not None:
+        return load_listings(cached["ids"]), cached["next_cursor"]
+
+    query = apply_listing_filters(Listing.query, filters)
+    items, next_cursor = paginate_listings(query, sort, cursor)
+    listing_cache.set(key, {"ids": [item.id for item in items], "next_cursor": next_cursor})
+    return items, next_cursor
+
+
+def front_page_listings(limit: int = 4) -> list:
+    key = cache_key("front", limit=limit)
+    ids = listing_cache.get(key)
+    if ids is None:
+        ids = [listing_id for (listing_id,) in db.session.query(Listing.id).order_by(Listing.id).limit(limit).all()]
+        listing_cache.set(key, ids)
+    return load_listings(ids)
+
+
+# ----------------------------
+# FACETS
+# ----------------------------
+
+PRICE_BUCKET = 250
+FACET_CITY_LIMIT = 10
+
+
+def listing_facets(filters: dict) -> dict:
+    """
+    Счётчики для фильтров /listings при текущем наборе фильтров:
+    по типу, по городу (топ FACET_CITY_LIMIT) и гистограмма цен с шагом PRICE_BUCKET.
+    Один GROUP BY (type, city_key, bucket) — маргиналы сворачиваются в Python;
+    результат кэшируется вместе с версией каталога.
+    """
+    key = cache_key("facets", filters=filters)
+    cached = listing_cache.get(key)
+    if cached is not None:
+        return cached
+
+    bucket = (Listing.price // PRICE_BUCKET).label("bucket")
+    query = db.session.query(
+        Listing.type, Listing.city_key, func.min(Listing.city), bucket, func.count()
+    )
+    query = apply_listing_filters(query, filters)
+    rows = query.group_by(Listing.type, Listing.city_key, bucket).all()
+
+    types, cities, city_names, prices = {}, {}, {}, {}
+    for type_, city_key, city, price_bucket, count in rows:
+        types[type_] = types.get(type_, 0) + count
+        cities[city_key] = cities.get(city_key, 0) + count
+        city_names.setdefault(city_key, city)
+        prices[price_bucket] = prices.get(price_bucket, 0) + count
+
+    top_cities = sorted(cities.items(), key=lambda kv: (-kv[1], kv[0]))[:FACET_CITY_LIMIT]
+    facets = {
+        "type": sorted(([t, n] for t, n in types.items()), key=lambda tn: -tn[1]),
+        "city": [[city_names[k], n] for k, n in top_cities],
+        "price": [
+            [b * PRICE_BUCKET, (b + 1) * PRICE_BUCKET - 1, n]
+            for b, n in sorted(prices.items())
+        ],
+    }
+    listing_cache.set(key, facets)
+    return facets
+
+
+class CityIndex:
+    """
+    Отсортированный in-memory список городов для автодополнения.
+    Пересобирается одним запросом раз в ttl секунд или после invalidate().
+    """
+
+    def __init__(self, ttl: int = 300):
+        self.ttl = ttl
+        self._entries = ([], [])  # (city_keys, display names), отсортировано по ключу
+        self._built_at = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._built_at = None
+
+    def _ensure_fresh(self):
+        if self._built_at is not None and time.monotonic() - self._built_at < self.ttl:
+            return
+        with self._lock:
+            if self._built_at is not None and time.monotonic() - self._built_at < self.ttl:
+                return
+            rows = (
+                db.session.query(Listing.city_key, func.min(Listing.city))
+                .filter(Listing.city_key.isnot(None), Listing.city_key != "")
+                .group_by(Listing.city_key)
+                .order_by(Listing.city_key)
+                .all()
+            )
+            self._entries = ([key for key, _ in rows], [name for _, name in rows])
+            self._built_at = time.monotonic()
+
+    def suggest(self, prefix: str, limit: int = 10) -> list:
+        key = normalize_city_key(prefix)
+        if not key:
+            return []
+        self._ensure_fresh()
+
+        keys, names = self._entries
+        result = []
+        i = bisect_left(keys, key)
+        while i < len(keys) and len(result) < limit and keys[i].startswith(key):
+            result.append(names[i])
+            i += 1
+        return result
+
+
+city_index = CityIndex()
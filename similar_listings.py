@@ -0,0 +1,131 @@
+# similar_listings.py
+# "Похожие объявления" на странице объявления: ближайшие соседи по эмбеддингу
+# заранее лежат в таблице similar_listing (top SIMILAR_COUNT на объявление),
+# так что страница делает один индексированный запрос вместо векторного поиска.
+# Полный пересчёт — build_similar_listings.py (блочное матричное умножение),
+# точечный — refresh_similar_listings() из фоновой очереди эмбеддингов.
+import os
+from collections import defaultdict
+
+import numpy as np
+
+from models import db, Listing, SimilarListing
+from vector_index import load_embedding_matrix, normalize_rows
+
+SIMILAR_COUNT = int(os.getenv("SIMILAR_COUNT", 8))
+
+
+def similar_listings(listing_id: int, limit: int = SIMILAR_COUNT) -> list:
+    """Соседи объявления по порядку (индекс — первичный ключ listing_id, rank)."""
+    return (
+        Listing.query
+        .join(SimilarListing, SimilarListing.neighbor_id == Listing.id)
+        .filter(SimilarListing.listing_id == listing_id)
+        .order_by(SimilarListing.rank)
+        .limit(limit)
+        .all()
+    )
+
+
+def write_similar(neighbours: dict):
+    """neighbours — {listing_id: [(neighbor_id, score), ...] по убыванию score}."""
+    if not neighbours:
+        return
+    SimilarListing.query \
+        .filter(SimilarListing.listing_id.in_(list(neighbours))) \
+        .delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(SimilarListing, [
+        {"listing_id": listing_id, "rank": rank, "neighbor_id": neighbor_id, "score": score}
+        for listing_id, items in neighbours.items()
+        for rank, (neighbor_id, score) in enumerate(items)
+    ])
+    db.session.commit()
+
+
+def remove_similar(listing_id: int):
+    """Убирает объявление из таблицы (в той же транзакции, что и удаление объявления)."""
+    SimilarListing.query.filter(
+        (SimilarListing.listing_id == listing_id) | (SimilarListing.neighbor_id == listing_id)
+    ).delete(synchronize_session=False)
+
+
+def rebuild_similar_listings(model: str = None, count: int = SIMILAR_COUNT, block: int = 256) -> int:
+    """
+    Полный пересчёт: сходства считаются блоками по block строк
+    (block x N float32 за раз), top-count — argpartition по строке.
+    Каждый блок коммитится отдельно, страницы видят старые или новые списки.
+    """
+    ids, matrix = load_embedding_matrix(model)
+    matrix = normalize_rows(matrix)
+    n = len(ids)
+    k = min(count, n - 1)
+
+    embedded = db.session.query(Listing.id).filter(Listing.embedding_blob.isnot(None))
+    if model:
+        embedded = embedded.filter(Listing.embedding_model == model)
+    SimilarListing.query \
+        .filter(SimilarListing.listing_id.notin_(embedded.scalar_subquery())) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+    if k <= 0:
+        return 0
+
+    for start in range(0, n, block):
+        end = min(start + block, n)
+        scores = matrix[start:end] @ matrix.T
+        scores[np.arange(end - start), np.arange(start, end)] = -np.inf  # себя не считаем
+
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        write_similar({
+            int(ids[start + row]): [
+                (int(ids[col]), float(score)) for col, score in zip(top[row], top_scores[row])
+            ]
+            for row in range(end - start)
+        })
+    return n
+
+
+def refresh_similar_listings(vectors: dict, index, count: int = SIMILAR_COUNT, fanout: int = 4):
+    """
+    Точечное обновление после пересчёта эмбеддингов vectors = {listing_id: vector}:
+    - списки самих объявлений переписываются по поиску в index;
+    - в чужие списки объявление попадает, если оно среди top count * fanout
+      кандидатов и лучше их худшего соседа; старые ссылки на него заменяются.
+    Списки, из которых объявление выпало, могут временно стать короче —
+    их дополнит следующий полный пересчёт.
+    """
+    changed = set(vectors)
+    neighbours, reverse = {}, defaultdict(dict)
+    for listing_id, vector in vectors.items():
+        hits = [(j, s) for j, s in index.search(vector, count * fanout + 1) if j != listing_id]
+        neighbours[listing_id] = hits[:count]
+        for j, score in hits:
+            if j not in changed:
+                reverse[j][listing_id] = score
+
+    referencing = db.session.query(SimilarListing.listing_id).filter(
+        SimilarListing.neighbor_id.in_(changed), SimilarListing.listing_id.notin_(changed)
+    )
+    affected = set(reverse) | {listing_id for (listing_id,) in referencing}
+
+    current = defaultdict(dict)
+    if affected:
+        rows = db.session.query(
+            SimilarListing.listing_id, SimilarListing.neighbor_id, SimilarListing.score
+        ).filter(SimilarListing.listing_id.in_(affected))
+        for listing_id, neighbor_id, score in rows:
+            current[listing_id][neighbor_id] = score
+
+    for listing_id in affected:
+        entries = {n: s for n, s in current[listing_id].items() if n not in changed}
+        entries.update(reverse.get(listing_id, {}))
+        merged = sorted(entries.items(), key=lambda item: -item[1])[:count]
+        if merged != sorted(current[listing_id].items(), key=lambda item: -item[1])[:count]:
+            neighbours[listing_id] = merged
+
+    write_similar(neighbours)
@@ -55,6 +55,62 @@ document.addEventListener("DOMContentLoaded", () => {
   }
 });
 
+// ----------------------------
+// DUPLICATE CHECK BEFORE UPLOAD (CREATE LISTING)
+// ----------------------------
+// Проверяем дубликаты до отправки формы: иначе сервер вернёт форму
+// с предупреждением, а выбранные фото пропадут.
+document.addEventListener("DOMContentLoaded", () => {
+  const form = document.getElementById("create-listing-form");
+  const warning = document.getElementById("duplicate-warning");
+  if (!form || !warning) return;
+
+  form.addEventListener("submit", async (e) => {
+    if (form.dataset.duplicatesChecked) return;
+    e.preventDefault();
+
+    let duplicates = [];
+    try {
+      const body = new FormData();
+      body.append("title", form.elements["title"].value);
+      body.append("description", form.elements["description"].value);
+      const res = await fetch("/api/listing-duplicates", { method: "POST", body });
+      if (res.ok) duplicates = await res.json();
+    } catch (err) {
+      duplicates = [];  // сервер всё равно проверит сам
+    }
+
+    form.dataset.duplicatesChecked = "1";
+    if (!duplicates.length) {
+      form.submit();
+      return;
+    }
+
+    warning.textContent = warning.dataset.title + " ";
+    duplicates.forEach((other, i) => {
+      const link = document.createElement("a");
+      link.href = "/listing/" + other.id;
+      link.target = "_blank";
+      link.textContent = `${other.title} (${other.city})`;
+      warning.appendChild(link);
+      if (i < duplicates.length - 1) warning.appendChild(document.createTextNode(", "));
+    });
+    const label = document.createElement("label");
+    label.style.display = "block";
+    label.style.marginTop = "8px";
+    const checkbox = document.createElement("input");
+    checkbox.type = "checkbox";
+    checkbox.name = "confirm_duplicate";
+    checkbox.value = "1";
+    checkbox.required = true;
+    label.appendChild(checkbox);
+    label.appendChild(document.createTextNode(" " + warning.dataset.confirm));
+    warning.appendChild(label);
+    warning.hidden = false;
+    warning.scrollIntoView({ block: "center" });
+  });
+});
+
 // ----------------------------
 // FILTER POPUPS
 // ----------------------------
@@ -81,21 +137,51 @@ document.addEventListener("click", function (e) {
 // APPLY FILTERS (LISTINGS)
 // ----------------------------
 function applyFilters() {
+  const q = document.getElementById("q-input")?.value.trim() || "";
   const city = document.getElementById("city-input")?.value || "";
   const min = document.getElementById("min-price")?.value || "";
   const max = document.getElementById("max-price")?.value || "";
   const type = document.getElementById("type-select")?.value || "";
+  const sort = document.getElementById("sort-select")?.value || "";
 
   const params = new URLSearchParams();
 
+  if (q) params.append("q", q);
   if (city) params.append("city", city);
   if (min) params.append("min_price", min);
   if (max) params.append("max_price", max);
   if (type) params.append("type", type);
+  if (sort) params.append("sort", sort);
 
   window.location.href = "/listings?" + params.toString();
 }
 
+// ----------------------------
+// CITY AUTOCOMPLETE (LISTINGS)
+// ----------------------------
+document.addEventListener("DOMContentLoaded", () => {
+  const cityInput = document.getElementById("city-input");
+  const suggestions = document.getElementById("city-suggestions");
+  if (!cityInput || !suggestions) return;
+
+  let timer = null;
+  cityInput.addEventListener("input", () => {
+    clearTimeout(timer);
+    timer = setTimeout(async () => {
+      const q = cityInput.value.trim();
+      if (!q) return;
+      const res = await fetch("/api/cities?q=" + encodeURIComponent(q));
+      const cities = await res.json();
+      suggestions.innerHTML = "";
+      cities.forEach(city => {
+        const option = document.createElement("option");
+        option.value = city;
+        suggestions.appendChild(option);
+      });
+    }, 150);
+  });
+});
+
 // =======================================================
 // GLOBAL CHAT: Enter = send, Shift+Enter = new line
 // =======================================================
@@ -0,0 +1,87 @@
+# upload_sink.py
+# Запись загрузок на диск за один проход: пока поток пишется во временный
+# файл рядом с целевым, считаются sha256 и размер, по первым байтам
+# определяется MIME-тип, а лимит размера файла проверяется по мере копирования
+# (второй рубеж: тело запроса целиком ограничено MAX_CONTENT_LENGTH в app.py,
+# его werkzeug проверяет ещё при чтении запроса).
+# Целевой путь появляется только целиком (os.replace), перечитывать файл
+# ради хэша не нужно. Используют все маршруты загрузки в app.py и blob_store.
+import hashlib
+import os
+import tempfile
+from collections import namedtuple
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", 20)) * 1024 * 1024
+
+UploadResult = namedtuple("UploadResult", "sha256 size mime")
+
+# (смещение, сигнатура, MIME) — хватает первых 16 байт
+_SIGNATURES = [
+    (0, b"%PDF-", "application/pdf"),
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (8, b"WEBP", "image/webp"),
+    (4, b"ftypheic", "image/heic"),
+    (4, b"ftypmif1", "image/heif"),
+    (0, b"PK\x03\x04", "application/zip"),
+]
+
+
+class UploadTooLarge(RequestEntityTooLarge):
+    """Загрузка больше лимита; Flask отвечает на неё 413."""
+
+
+def sniff_mime(head: bytes):
+    for offset, signature, mime in _SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            if mime == "image/webp" and not head.startswith(b"RIFF"):
+                continue
+            return mime
+    return None
+
+
+def write_temp(stream, directory: str, max_bytes: int = MAX_UPLOAD_BYTES):
+    """
+    Пишет поток во временный файл в directory.
+    Возвращает (путь к временному файлу, UploadResult); при ошибке
+    или превышении max_bytes временный файл удаляется.
+    """
+    os.makedirs(directory, exist_ok=True)
+    digest, size, head = hashlib.sha256(), 0, b""
+    with tempfile.NamedTemporaryFile(dir=directory, prefix=".upload-", delete=False) as tmp:
+        try:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    raise UploadTooLarge(f"Файл больше {max_bytes // (1024 * 1024)} МБ")
+                if len(head) < 16:
+                    head += chunk[:16 - len(head)]
+                digest.update(chunk)
+                tmp.write(chunk)
+        except BaseException:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+    return tmp.name, UploadResult(digest.hexdigest(), size, sniff_mime(head))
+
+
+def write_file(stream, path: str, max_bytes: int = MAX_UPLOAD_BYTES) -> UploadResult:
+    tmp_path, result = write_temp(stream, os.path.dirname(path), max_bytes)
+    os.replace(tmp_path, path)
+    return result
+
+
+def save_upload(file_storage, path: str, max_bytes: int = MAX_UPLOAD_BYTES) -> UploadResult:
+    """FileStorage -> path, вместо f.save(path) + sha256_file(path)."""
+    return write_file(file_storage.stream, path, max_bytes)
+
+
+def copy_file(src: str, dst: str) -> UploadResult:
+    """shutil.copyfile с хэшем по ходу копирования (без лимита размера)."""
+    with open(src, "rb") as f:
+        return write_file(f, dst, max_bytes=None)
@@ -0,0 +1,1048 @@
+# vector_index.py
+# In-memory индекс эмбеддингов объявлений для /ai-search:
+# точный brute-force (VectorIndex), приближённый IVF (IVFIndex) или сжатый int8
+# (QuantizedIndex). Рядом с матрицей лежат колонки price / type / city_key,
+# по которым фильтры /listings применяются как NumPy-маски до скоринга.
+#
+# Если задан VECTOR_SNAPSHOT_DIR, build_embeddings.py пишет туда версионный
+# снимок (матрица .npy + id + хэши текстов + кластеры IVF + JSON-заголовок), а воркеры
+# открывают его через np.memmap: страницы матрицы общие для всех процессов
+# через page cache, эмбеддинги новее снимка докладываются дельтой из базы.
+import glob
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import numpy as np
+from flask import current_app
+
+from models import db, Listing, EMBEDDING_DTYPES
+from search_utils import city_key_range
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-9)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Позиции k наибольших scores по убыванию (argpartition + сортировка только k)."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+class ReadWriteLock:
+    """
+    Поиски (read) идут параллельно — matrix-vector product отпускает GIL,
+    записи и подмены (write) — по одной и без поисков. Ждущая запись не
+    пропускает новых читателей. Не реентерабельна.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class VectorIndex:
+    """
+    Brute-force косинусный поиск: все векторы лежат одной нормализованной
+    float32-матрицей, top-k = один matrix-vector product + argpartition.
+    Поддерживает точечные upsert/remove без пересборки (ёмкость растёт удвоением).
+
+    attributes — {"price": ..., "type": ..., "city_key": ...}: цена хранится
+    float64-колонкой (NaN = нет цены), тип и город — int32-кодами словаря
+    (-1 = нет значения). Строки без атрибутов под фильтры не попадают,
+    как NULL в SQL.
+    """
+
+    row_dtype = np.float32
+    attribute_names = ("price", "type", "city_key")
+    block_rows = 4096
+    # с такой долей подходящих строк фильтр дешевле применить к скорам всей
+    # матрицы (-inf вне маски), чем копировать подходящие строки
+    dense_filter = 0.25
+
+    def __init__(self):
+        self._lock = ReadWriteLock()
+        self._matrix = np.empty((0, 0), dtype=self.row_dtype)
+        self._ids = np.empty(0, dtype=np.int64)
+        self._size = 0
+        self._dim = 0
+        self._pos = {}  # listing_id -> строка матрицы
+        self._price = np.empty(0, dtype=np.float64)
+        self._type_code = np.empty(0, dtype=np.int32)
+        self._city_code = np.empty(0, dtype=np.int32)
+        self._vocab = {"type": {}, "city_key": {}}  # значение -> код
+        self.loaded_at = None
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def dim(self) -> int:
+        """Размерность входных эмбеддингов."""
+        return self._dim
+
+    def memory_bytes(self) -> int:
+        return self._matrix[:self._size].nbytes + self._ids[:self._size].nbytes
+
+    def build(self, ids, vectors, attributes: dict = None, normalized: bool = False):
+        """
+        attributes — колонки {"price": [...], "type": [...], "city_key": [...]} в порядке ids.
+        normalized=True — vectors уже нормализованный float32 (например, memmap снимка)
+        и используется как есть, без копии.
+        """
+        if not normalized:
+            vectors = normalize_rows(vectors)
+        attributes = attributes or {}
+        with self._lock.write():
+            self._ids = np.asarray(ids, dtype=np.int64)
+            self._size = len(self._ids)
+            self._dim = vectors.shape[1] if self._size else 0
+            self._pos = {int(i): row for row, i in enumerate(self._ids)}
+            self._vocab = {"type": {}, "city_key": {}}
+            self._price = np.array(
+                [np.nan if p is None else p for p in attributes.get("price", [None] * self._size)],
+                dtype=np.float64
+            )
+            self._type_code = self._encode_column("type", attributes.get("type"))
+            self._city_code = self._encode_column("city_key", attributes.get("city_key"))
+            self._store_all(vectors)
+            self._after_build()
+            self.loaded_at = time.monotonic()
+
+    def _code(self, name: str, value) -> int:
+        if value is None or value == "":
+            return -1
+        vocab = self._vocab[name]
+        return vocab.setdefault(value, len(vocab))
+
+    def _encode_column(self, name: str, values) -> np.ndarray:
+        if values is None:
+            return np.full(self._size, -1, dtype=np.int32)
+        return np.fromiter((self._code(name, v) for v in values), dtype=np.int32, count=self._size)
+
+    def _write_attributes(self, row: int, attributes: dict):
+        price = attributes.get("price")
+        self._price[row] = np.nan if price is None else price
+        self._type_code[row] = self._code("type", attributes.get("type"))
+        self._city_code[row] = self._code("city_key", attributes.get("city_key"))
+
+    def set_attributes(self, listing_id: int, attributes: dict):
+        """Обновляет фильтруемые колонки (цена/тип/город изменились, эмбеддинг — нет)."""
+        with self._lock.write():
+            row = self._pos.get(listing_id)
+            if row is not None:
+                self._write_attributes(row, attributes)
+
+    def upsert(self, listing_id: int, vector, attributes: dict = None):
+        vector = normalize_rows(vector).ravel()
+        with self._lock.write():
+            if self._size and vector.shape[0] != self._dim:
+                raise ValueError(f"Embedding dim {vector.shape[0]} != index dim {self._dim}")
+            self._dim = vector.shape[0]
+            row = self._pos.get(listing_id)
+            if row is None:
+                self._reserve(self._size + 1)
+                row = self._size
+                self._size += 1
+                self._ids[row] = listing_id
+                self._pos[listing_id] = row
+                self._write_attributes(row, attributes or {})
+            elif attributes is not None:
+                self._write_attributes(row, attributes)
+            self._store(row, vector)
+            self._after_write(row)
+
+    def remove(self, listing_id: int):
+        with self._lock.write():
+            row = self._pos.pop(listing_id, None)
+            if row is None:
+                return
+            last = self._size - 1
+            if row != last:
+                # последняя строка переезжает на место удалённой
+                self._matrix[row] = self._matrix[last]
+                self._ids[row] = self._ids[last]
+                self._price[row] = self._price[last]
+                self._type_code[row] = self._type_code[last]
+                self._city_code[row] = self._city_code[last]
+                self._pos[int(self._ids[row])] = row
+                self._after_move(last, row)
+            self._size = last
+
+    def _reserve(self, size: int):
+        capacity = self._matrix.shape[0]
+        width = self._row_width()
+        if size <= capacity and self._matrix.shape[1] == width:
+            return
+        new_capacity = max(size, capacity * 2, 16)
+        matrix = np.empty((new_capacity, width), dtype=self.row_dtype)
+        ids = np.empty(new_capacity, dtype=np.int64)
+        price = np.full(new_capacity, np.nan, dtype=np.float64)
+        type_code = np.full(new_capacity, -1, dtype=np.int32)
+        city_code = np.full(new_capacity, -1, dtype=np.int32)
+        if self._size:
+            matrix[:self._size] = self._matrix[:self._size]
+            ids[:self._size] = self._ids[:self._size]
+            price[:self._size] = self._price[:self._size]
+            type_code[:self._size] = self._type_code[:self._size]
+            city_code[:self._size] = self._city_code[:self._size]
+        self._matrix, self._ids = matrix, ids
+        self._price, self._type_code, self._city_code = price, type_code, city_code
+        self._after_resize(new_capacity)
+
+    # точки расширения для производных индексов
+    def _row_width(self) -> int:
+        return self._dim
+
+    def _store_all(self, vectors: np.ndarray):
+        self._matrix = np.ascontiguousarray(vectors)
+
+    def _store(self, row: int, vector: np.ndarray):
+        self._matrix[row] = vector
+
+    def _score(self, rows, query: np.ndarray) -> np.ndarray:
+        if rows is None:
+            return self._matrix[:self._size] @ query
+        # выборка строк копирует их — блоками, чтобы временная память не росла с len(rows)
+        scores = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), self.block_rows):
+            block = rows[start:start + self.block_rows]
+            scores[start:start + len(block)] = self._matrix[block] @ query
+        return scores
+
+    def _after_build(self):
+        pass
+
+    def _after_write(self, row: int):
+        pass
+
+    def _after_move(self, src: int, dst: int):
+        pass
+
+    def _after_resize(self, capacity: int):
+        pass
+
+    def _candidate_rows(self, query):
+        """Строки-кандидаты для запроса; None — все строки."""
+        return None
+
+    def filter_mask(self, filters: dict):
+        """
+        Булева маска строк под фильтры parse_listing_filters (city, min_price,
+        max_price, type; q здесь не участвует). None — фильтров нет.
+        """
+        if not filters:
+            return None
+        n = self._size
+        mask = None
+
+        def narrow(condition):
+            nonlocal mask
+            mask = condition if mask is None else mask & condition
+
+        if filters.get("min_price") is not None:
+            narrow(self._price[:n] >= filters["min_price"])
+        if filters.get("max_price") is not None:
+            narrow(self._price[:n] <= filters["max_price"])
+        if filters.get("type"):
+            code = self._vocab["type"].get(filters["type"], -2)
+            narrow(self._type_code[:n] == code)
+        key_range = city_key_range(filters.get("city") or "")
+        if key_range:
+            low, high = key_range
+            # префикс города -> множество кодов по словарю (городов немного)
+            codes = [code for key, code in self._vocab["city_key"].items() if low <= key < high]
+            narrow(np.isin(self._city_code[:n], codes))
+        return mask
+
+    def search(self, query, k: int = 10, filters: dict = None) -> list:
+        """
+        Возвращает [(listing_id, cosine score), ...] по убыванию score.
+        С filters: если подходящих строк мало, скорятся только они; если много —
+        скорится вся матрица, а остальные строки получают -inf.
+        """
+        query = normalize_rows(query).ravel()
+        with self._lock.read():
+            if self._size == 0 or k <= 0:
+                return []
+            rows = self._candidate_rows(query)
+            mask = self.filter_mask(filters)
+            excluded = None
+            if mask is not None:
+                eligible = int(np.count_nonzero(mask))
+                if not eligible:
+                    return []
+                k = min(k, eligible)
+                if rows is not None and eligible > len(rows):
+                    rows = rows[mask[rows]]
+                    if len(rows) < k:
+                        # в пробных кластерах подходящих мало — точный поиск по всем подходящим
+                        rows = None
+                else:
+                    rows = None
+                if rows is None:
+                    if eligible >= self.dense_filter * self._size:
+                        excluded = ~mask
+                    else:
+                        rows = np.flatnonzero(mask)
+            scores = self._score(rows, query)
+            if excluded is not None:
+                scores[excluded] = -np.inf
+            top = top_k(scores, k)
+            top_rows = top if rows is None else rows[top]
+            return [(int(self._ids[row]), float(scores[t])) for row, t in zip(top_rows, top)]
+
+
+def train_kmeans(vectors: np.ndarray, nlist: int, iters: int = 10, seed: int = 0) -> np.ndarray:
+    """Сферический k-means (косинус) для нормализованных векторов. Возвращает центроиды (nlist, dim)."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        counts = np.bincount(assign, minlength=nlist)
+        empty = counts == 0
+        if empty.any():
+            # пустые кластеры пересеиваем случайными точками
+            sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+class IVFIndex(VectorIndex):
+    """
+    Приближённый поиск (IVF): k-means разбивает векторы на nlist кластеров,
+    запрос сравнивается с центроидами и сканирует только nprobe ближайших
+    кластеров. nprobe — ручка recall/latency (nprobe = nlist == brute force).
+    Новые векторы приписываются к ближайшему существующему центроиду.
+    Со снимком кластеры обучаются офлайн (write_snapshot) и только читаются.
+    """
+
+    def __init__(self, nlist: int = None, nprobe: int = 8, train_size: int = 100_000,
+                 iters: int = 10, seed: int = 0):
+        super().__init__()
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_size = train_size
+        self.iters = iters
+        self.seed = seed
+        self._centroids = None
+        self._assign = np.empty(0, dtype=np.int32)
+        self._pretrained = None
+
+    def train(self, vectors: np.ndarray):
+        """
+        k-means по нормализованным vectors (на выборке до train_size) и кластер
+        каждой строки. Возвращает (centroids, assign) — их можно посчитать
+        офлайн и сохранить в снимок (write_snapshot), см. use_clusters().
+        """
+        n = len(vectors)
+        nlist = min(self.nlist or max(1, int(4 * np.sqrt(n))), n)
+        sample = vectors
+        if n > self.train_size:
+            sample = vectors[np.random.default_rng(self.seed).choice(n, self.train_size, replace=False)]
+        centroids = train_kmeans(np.asarray(sample, dtype=np.float32), nlist, self.iters, self.seed)
+
+        assign = np.empty(n, dtype=np.int32)
+        for start in range(0, n, 65536):
+            chunk = vectors[start:start + 65536]
+            assign[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+        return centroids, assign
+
+    def use_clusters(self, centroids: np.ndarray, assign: np.ndarray):
+        """Готовые кластеры для следующего build() вместо обучения (строки в том же порядке)."""
+        self._pretrained = (centroids, assign)
+
+    def _after_build(self):
+        n = self._size
+        pretrained, self._pretrained = self._pretrained, None
+        self._assign = np.zeros(len(self._ids), dtype=np.int32)
+        self._centroids = None
+        if n == 0:
+            return
+        if pretrained is not None and len(pretrained[1]) == n:
+            self._centroids = np.asarray(pretrained[0], dtype=np.float32)
+            self._assign[:] = pretrained[1]
+        else:
+            self._centroids, self._assign[:n] = self.train(self._matrix[:n])
+
+    def _after_write(self, row: int):
+        if self._centroids is not None:
+            self._assign[row] = np.argmax(self._centroids @ self._matrix[row])
+
+    def _after_move(self, src: int, dst: int):
+        self._assign[dst] = self._assign[src]
+
+    def _after_resize(self, capacity: int):
+        assign = np.zeros(capacity, dtype=np.int32)
+        assign[:self._size] = self._assign[:self._size]
+        self._assign = assign
+
+    def _candidate_rows(self, query):
+        if self._centroids is None:
+            return None
+        nprobe = min(self.nprobe, len(self._centroids))
+        probe = top_k(self._centroids @ query, nprobe)
+        return np.flatnonzero(np.isin(self._assign[:self._size], probe))
+
+
+class QuantizedIndex(VectorIndex):
+    """
+    Сжатый brute-force индекс: векторы уменьшаются до dims измерений
+    (method="truncate" — Matryoshka-обрезка, text-embedding-3 это допускает;
+    method="pca" — проекция на главные компоненты) и хранятся как int8
+    с float32-масштабом на вектор (~dims + 4 байта вместо 4 * dim).
+    Первичный отбор идёт по int8-кодам, затем top k * rerank кандидатов
+    пересчитываются по полным float32-векторам из loader(ids).
+    """
+
+    row_dtype = np.int8
+
+    def __init__(self, dims: int = 512, method: str = "truncate", rerank: int = 4,
+                 loader=None, pca_sample: int = 20000, seed: int = 0):
+        super().__init__()
+        if method not in ("truncate", "pca"):
+            raise ValueError(f"Unknown compression method: {method}")
+        self.dims = dims
+        self.method = method
+        self.rerank = rerank
+        self.loader = loader
+        self.pca_sample = pca_sample
+        self.seed = seed
+        self._projection = None  # (dim, dims) для pca
+        self._scales = np.empty(0, dtype=np.float32)
+
+    def memory_bytes(self) -> int:
+        extra = self._scales[:self._size].nbytes
+        if self._projection is not None:
+            extra += self._projection.nbytes
+        return super().memory_bytes() + extra
+
+    def _row_width(self) -> int:
+        return min(self.dims, self._dim)
+
+    def _reduce(self, vectors: np.ndarray) -> np.ndarray:
+        if self._projection is not None:
+            reduced = vectors @ self._projection
+        else:
+            reduced = vectors[..., :self._row_width()]
+        return normalize_rows(reduced)
+
+    def _fit_projection(self, vectors: np.ndarray):
+        self._projection = None
+        if self.method != "pca" or not len(vectors) or self.dims >= self._dim:
+            return
+        if len(vectors) > self.pca_sample:
+            sample = np.random.default_rng(self.seed).choice(len(vectors), self.pca_sample, replace=False)
+            vectors = vectors[sample]
+        # без центрирования: сохраняем скалярные произведения, а не дисперсию
+        second_moment = vectors.T @ vectors
+        _, eigvecs = np.linalg.eigh(second_moment)
+        self._projection = np.ascontiguousarray(eigvecs[:, ::-1][:, :self.dims], dtype=np.float32)
+
+    @staticmethod
+    def _quantize(reduced: np.ndarray):
+        scales = np.abs(reduced).max(axis=-1) / 127
+        scales = np.maximum(scales, 1e-12).astype(np.float32)
+        codes = np.rint(reduced / scales[..., None]).astype(np.int8)
+        return codes, scales
+
+    def _store_all(self, vectors):
+        self._fit_projection(vectors)
+        if not len(vectors):
+            self._matrix = np.empty((0, 0), dtype=self.row_dtype)
+            self._scales = np.empty(0, dtype=np.float32)
+            return
+        self._matrix, self._scales = self._quantize(self._reduce(vectors))
+
+    def _store(self, row, vector):
+        codes, scale = self._quantize(self._reduce(vector))
+        self._matrix[row] = codes
+        self._scales[row] = scale
+
+    def _after_move(self, src, dst):
+        self._scales[dst] = self._scales[src]
+
+    def _after_resize(self, capacity):
+        scales = np.empty(capacity, dtype=np.float32)
+        scales[:self._size] = self._scales[:self._size]
+        self._scales = scales
+
+    def _score(self, rows, query):
+        query = self._reduce(query)
+        n = self._size if rows is None else len(rows)
+        # блоками, чтобы не разворачивать весь int8-массив во float32 разом
+        scores = np.empty(n, dtype=np.float32)
+        for start in range(0, n, self.block_rows):
+            block = slice(start, min(start + self.block_rows, n))
+            selected = block if rows is None else rows[block]
+            scores[block] = (self._matrix[selected].astype(np.float32) @ query) * self._scales[selected]
+        return scores
+
+    def search(self, query, k: int = 10, filters: dict = None) -> list:
+        if not self.loader:
+            return super().search(query, k, filters)
+
+        candidates = super().search(query, k * self.rerank, filters)
+        if not candidates:
+            return []
+        ids = [listing_id for listing_id, _ in candidates]
+        full = self.loader(ids)
+        if full.ndim != 2 or full.shape[1] != self._dim:
+            return candidates[:k]
+        exact = normalize_rows(full) @ normalize_rows(query).ravel()
+        return [(ids[i], float(exact[i])) for i in top_k(exact, k)]
+
+
+class LiveIndex:
+    """
+    Индекс процесса: base — индекс выбранного типа (make_index), собранный из базы
+    или поверх memmap снимка; delta — небольшой brute-force индекс для эмбеддингов,
+    появившихся или изменившихся после снимка. Строки снимка только читаются
+    (copy-on-write), поэтому в режиме снимка upsert идёт в дельту, а устаревшая
+    строка убирается из base. Поиск сливает top-k обоих индексов; поиски
+    идут параллельно, записи и подмены ждут их (ReadWriteLock).
+    """
+
+    def __init__(self, base: VectorIndex):
+        self._lock = ReadWriteLock()
+        self.base = base
+        self.delta = VectorIndex()
+        self.snapshot_version = None
+        self.loaded_at = None
+        self.synced_at = None  # datetime: эмбеддинги, записанные до этого момента, уже в индексе
+        self.polled = {}  # listing_id -> embedding_updated_at, уже долитые опросом (окно POLL_OVERLAP)
+        self._journal = None  # записи во время фоновой пересборки, см. begin_reload()
+
+    def begin_reload(self):
+        """Дальше upsert/remove/set_attributes запоминаются, чтобы повторить их в новом индексе."""
+        with self._lock.write():
+            self._journal = []
+
+    def finish_reload(self, fresh: "LiveIndex"):
+        """Атомарно подменяет содержимое собранным в фоне fresh, доиграв записи за время сборки."""
+        with self._lock.write():
+            for method, args in self._journal or []:
+                getattr(fresh, method)(*args)
+            self.base, self.delta = fresh.base, fresh.delta
+            self.snapshot_version, self.loaded_at = fresh.snapshot_version, fresh.loaded_at
+            self.synced_at, self.polled = fresh.synced_at, fresh.polled
+            self._journal = None
+
+    def abort_reload(self):
+        with self._lock.write():
+            self._journal = None
+
+    def _record(self, method: str, *args):
+        if self._journal is not None:
+            self._journal.append((method, args))
+
+    def __len__(self):
+        return len(self.base) + len(self.delta)
+
+    @property
+    def dim(self) -> int:
+        return self.base.dim or self.delta.dim
+
+    def build(self, ids, vectors, attributes: dict = None):
+        with self._lock.write():
+            self.base.build(ids, vectors, attributes)
+            self.delta = VectorIndex()
+            self.snapshot_version = None
+            self.loaded_at = time.monotonic()
+
+    def load_snapshot(self, version: int, ids, matrix, attributes: dict, stale_ids,
+                      delta_ids, delta_matrix, delta_attributes: dict):
+        with self._lock.write():
+            self.base.build(ids, matrix, attributes, normalized=True)
+            for listing_id in stale_ids:
+                self.base.remove(int(listing_id))
+            self.delta = VectorIndex()
+            self.delta.build(delta_ids, delta_matrix, delta_attributes)
+            self.snapshot_version = version
+            self.loaded_at = time.monotonic()
+
+    def upsert(self, listing_id: int, vector, attributes: dict = None):
+        with self._lock.write():
+            self._record("upsert", listing_id, vector, attributes)
+            if self.snapshot_version is None:
+                self.base.upsert(listing_id, vector, attributes)
+            else:
+                self.base.remove(listing_id)
+                self.delta.upsert(listing_id, vector, attributes)
+
+    def remove(self, listing_id: int):
+        with self._lock.write():
+            self._record("remove", listing_id)
+            self.base.remove(listing_id)
+            self.delta.remove(listing_id)
+
+    def set_attributes(self, listing_id: int, attributes: dict):
+        with self._lock.write():
+            self._record("set_attributes", listing_id, attributes)
+            self.base.set_attributes(listing_id, attributes)
+            self.delta.set_attributes(listing_id, attributes)
+
+    def search(self, query, k: int = 10, filters: dict = None) -> list:
+        with self._lock.read():
+            results = self.base.search(query, k, filters)
+            if len(self.delta):
+                results = sorted(
+                    results + self.delta.search(query, k, filters), key=lambda r: -r[1]
+                )[:k]
+            return results
+
+
+def make_index(kind: str = None) -> VectorIndex:
+    """
+    VECTOR_INDEX=brute (по умолчанию) | ivf | quantized;
+    VECTOR_IVF_NLIST, VECTOR_IVF_NPROBE;
+    VECTOR_QUANT_DIMS, VECTOR_QUANT_METHOD (truncate | pca), VECTOR_RERANK.
+    """
+    kind = kind or os.getenv("VECTOR_INDEX", "brute")
+    if kind == "ivf":
+        nlist = os.getenv("VECTOR_IVF_NLIST")
+        return IVFIndex(
+            nlist=int(nlist) if nlist else None,
+            nprobe=int(os.getenv("VECTOR_IVF_NPROBE", 8))
+        )
+    if kind == "quantized":
+        return QuantizedIndex(
+            dims=int(os.getenv("VECTOR_QUANT_DIMS", 512)),
+            method=os.getenv("VECTOR_QUANT_METHOD", "truncate"),
+            rerank=int(os.getenv("VECTOR_RERANK", 4)),
+            loader=fetch_embeddings
+        )
+    return VectorIndex()
+
+
+def load_embedding_matrix(model: str = None):
+    """
+    Читает сохранённые эмбеддинги одним запросом и декодирует их одним
+    np.frombuffer на группу (dtype, dim), без поштучной распаковки.
+    Строки с размерностью, отличной от преобладающей, пропускаются.
+    Возвращает (ids int64, matrix float32).
+    """
+    query = db.session.query(
+        Listing.id, Listing.embedding_blob, Listing.embedding_dtype, Listing.embedding_dim
+    ).filter(Listing.embedding_blob.isnot(None))
+    if model:
+        query = query.filter(Listing.embedding_model == model)
+
+    groups = {}
+    for listing_id, blob, dtype, dim in query.order_by(Listing.id).all():
+        group = groups.setdefault((dtype or "float32", dim), ([], []))
+        group[0].append(listing_id)
+        group[1].append(blob)
+
+    if not groups:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+
+    dims = {}
+    for (_, dim), (ids, _) in groups.items():
+        dims[dim] = dims.get(dim, 0) + len(ids)
+    dim = max(dims, key=dims.get)
+
+    all_ids, parts = [], []
+    for (dtype, group_dim), (ids, blobs) in groups.items():
+        if group_dim != dim:
+            continue
+        all_ids.extend(ids)
+        parts.append(
+            np.frombuffer(b"".join(blobs), dtype=EMBEDDING_DTYPES[dtype]).reshape(len(ids), dim)
+        )
+    return np.asarray(all_ids, dtype=np.int64), np.concatenate(parts).astype(np.float32, copy=False)
+
+
+def listing_attributes(listing) -> dict:
+    return {"price": listing.price, "type": listing.type, "city_key": listing.city_key}
+
+
+def load_listing_attributes(ids) -> dict:
+    """Колонки price / type / city_key в порядке ids — для фильтров индекса."""
+    query = db.session.query(Listing.id, Listing.price, Listing.type, Listing.city_key)
+    if len(ids) <= 500:
+        query = query.filter(Listing.id.in_([int(i) for i in ids]))
+    rows = {row.id: row for row in query}
+    columns = {name: [] for name in VectorIndex.attribute_names}
+    for listing_id in ids:
+        row = rows.get(int(listing_id))
+        for name in VectorIndex.attribute_names:
+            columns[name].append(getattr(row, name) if row else None)
+    return columns
+
+
+def fetch_embeddings(ids: list) -> np.ndarray:
+    """Полные float32-эмбеддинги по списку id (в том же порядке) — для re-ranking."""
+    rows = db.session.query(Listing.id, Listing.embedding_blob, Listing.embedding_dtype) \
+        .filter(Listing.id.in_(ids)) \
+        .all()
+    by_id = {
+        listing_id: np.frombuffer(blob, dtype=EMBEDDING_DTYPES[dtype or "float32"])
+        for listing_id, blob, dtype in rows if blob
+    }
+    dim = len(next(iter(by_id.values()))) if by_id else 0
+    matrix = np.zeros((len(ids), dim), dtype=np.float32)
+    for row, listing_id in enumerate(ids):
+        vector = by_id.get(listing_id)
+        if vector is not None and len(vector) == dim:
+            matrix[row] = vector
+    return matrix
+
+
+listing_index = LiveIndex(make_index())
+
+
+# ----------------------------
+# SNAPSHOT (np.memmap)
+# ----------------------------
+
+SNAPSHOT_DIR = os.getenv("VECTOR_SNAPSHOT_DIR")
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_KEEP = 2  # предыдущую версию не удаляем сразу: её ещё могут держать воркеры
+SNAPSHOT_HEADER = "listings.json"
+
+
+def snapshot_paths(directory: str, version: int) -> dict:
+    prefix = os.path.join(directory, f"listings-{version:06d}")
+    return {
+        "matrix": prefix + ".npy",        # (count, dim) float32, строки нормализованы
+        "ids": prefix + ".ids.npy",       # int64
+        "hashes": prefix + ".hashes.npy", # S64, Listing.embedding_text_hash на момент снимка
+        "centroids": prefix + ".centroids.npy",  # только для VECTOR_INDEX=ivf: (nlist, dim) float32
+        "assign": prefix + ".assign.npy",        # и кластер каждой строки, int32
+    }
+
+
+def read_snapshot_header(directory: str = None):
+    directory = directory or SNAPSHOT_DIR
+    try:
+        with open(os.path.join(directory, SNAPSHOT_HEADER), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def embedding_hashes(model: str = None) -> dict:
+    """{listing_id: embedding_text_hash} для объявлений с эмбеддингом модели model."""
+    query = db.session.query(Listing.id, Listing.embedding_text_hash) \
+        .filter(Listing.embedding_blob.isnot(None))
+    if model:
+        query = query.filter(Listing.embedding_model == model)
+    return dict(query.all())
+
+
+def write_snapshot(model: str = None, directory: str = None) -> dict:
+    """
+    Пишет новую версию снимка и атомарно публикует её заменой заголовка
+    (os.replace), так что воркеры видят либо старую, либо новую версию целиком.
+    """
+    directory = directory or SNAPSHOT_DIR
+    os.makedirs(directory, exist_ok=True)
+
+    ids, matrix = load_embedding_matrix(model)
+    hashes = embedding_hashes(model)
+    previous = read_snapshot_header(directory)
+    version = previous["version"] + 1 if previous else 1
+    paths = snapshot_paths(directory, version)
+
+    matrix = normalize_rows(matrix)
+    np.save(paths["matrix"], matrix)
+    np.save(paths["ids"], ids)
+    np.save(paths["hashes"], np.array([hashes.get(int(i)) or "" for i in ids], dtype="S64"))
+
+    # k-means для IVF обучается здесь, офлайн, а не в воркерах при загрузке
+    index = make_index()
+    ivf = isinstance(index, IVFIndex) and len(ids) > 0
+    if ivf:
+        centroids, assign = index.train(matrix)
+        np.save(paths["centroids"], centroids)
+        np.save(paths["assign"], assign)
+
+    header = {
+        "format": SNAPSHOT_FORMAT,
+        "version": version,
+        "model": model,
+        "count": len(ids),
+        "dim": matrix.shape[1],
+        "dtype": "float32",
+        "ivf": ivf,
+        "created_at": datetime.utcnow().isoformat(),
+    }
+    tmp_path = os.path.join(directory, SNAPSHOT_HEADER + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(header, f)
+    os.replace(tmp_path, os.path.join(directory, SNAPSHOT_HEADER))
+
+    for path in glob.glob(os.path.join(directory, "listings-*.npy")):
+        match = re.match(r"listings-(\d+)\.", os.path.basename(path))
+        if match and int(match.group(1)) <= version - SNAPSHOT_KEEP:
+            os.remove(path)
+    return header
+
+
+def open_snapshot(model: str = None, directory: str = None):
+    """
+    (header, ids, matrix memmap, hashes, clusters) текущей версии или None;
+    clusters — (centroids, assign) обученного офлайн IVF или None.
+    """
+    directory = directory or SNAPSHOT_DIR
+    if not directory:
+        return None
+    header = read_snapshot_header(directory)
+    if not header or header.get("format") != SNAPSHOT_FORMAT:
+        return None
+    if model and header.get("model") and header["model"] != model:
+        return None
+
+    paths = snapshot_paths(directory, header["version"])
+    try:
+        # mmap_mode="c": remove() устаревших строк копирует только затронутые страницы
+        matrix = np.load(paths["matrix"], mmap_mode="c" if header["count"] else None)
+        ids = np.load(paths["ids"])
+        hashes = np.load(paths["hashes"])
+        clusters = (np.load(paths["centroids"]), np.load(paths["assign"])) if header.get("ivf") else None
+    except (OSError, ValueError):
+        return None
+    return header, ids, matrix, hashes, clusters
+
+
+def load_snapshot_index(index: LiveIndex, snapshot, model: str = None):
+    """
+    Поднимает index из снимка: строки, чей текст с тех пор изменился или
+    чьё объявление удалено, скрываются, а новые и пересчитанные эмбеддинги
+    читаются из базы в дельту.
+    """
+    header, ids, matrix, hashes, clusters = snapshot
+    if clusters is not None and isinstance(index.base, IVFIndex):
+        index.base.use_clusters(*clusters)
+    current = embedding_hashes(model)
+
+    snapshot_hashes = {int(i): h.decode() for i, h in zip(ids, hashes)}
+    stale_ids = [i for i, h in snapshot_hashes.items() if current.get(i) != h]
+    delta_ids = [i for i, h in current.items() if snapshot_hashes.get(i) != h]
+
+    delta_matrix = fetch_embeddings(delta_ids) if delta_ids else np.empty((0, 0), dtype=np.float32)
+    if delta_ids and header["count"] and delta_matrix.shape[1] != header["dim"]:
+        delta_ids, delta_matrix = [], np.empty((0, 0), dtype=np.float32)
+
+    index.load_snapshot(
+        header["version"], ids, matrix, load_listing_attributes(ids), stale_ids,
+        delta_ids, delta_matrix, load_listing_attributes(delta_ids)
+    )
+
+
+def load_listing_index(model: str = None, train: bool = True) -> LiveIndex:
+    """
+    Собирает новый LiveIndex из снимка (VECTOR_SNAPSHOT_DIR) или из базы.
+    train=False — не обучать k-means: IVF без кластеров из снимка
+    собирается brute-force индексом (см. IndexReloader.load).
+    """
+    snapshot = open_snapshot(model)
+    base = make_index()
+    if not train and isinstance(base, IVFIndex) and (snapshot is None or snapshot[4] is None):
+        base = VectorIndex()
+    index = LiveIndex(base)
+    index.synced_at = datetime.utcnow()
+    # строки из окна опроса загружаются сейчас — первый опрос их не перечитывает
+    index.polled = dict(embedding_updates(index.synced_at - POLL_OVERLAP, model))
+    if snapshot is not None:
+        load_snapshot_index(index, snapshot, model)
+    else:
+        ids, matrix = load_embedding_matrix(model)
+        index.build(ids, matrix, load_listing_attributes(ids))
+    return index
+
+
+def reload_listing_index(model: str = None, train: bool = True):
+    """Пересобирает индекс в стороне и подменяет им listing_index; поиск ждёт только подмену."""
+    listing_index.begin_reload()
+    try:
+        fresh = load_listing_index(model, train)
+    except BaseException:
+        listing_index.abort_reload()
+        raise
+    listing_index.finish_reload(fresh)
+
+
+POLL_INTERVAL = float(os.getenv("VECTOR_POLL_INTERVAL", 5))
+# запись с более ранним embedding_updated_at может закоммититься позже опроса
+POLL_OVERLAP = timedelta(seconds=30)
+POLL_LIMIT = 5000
+
+
+def embedding_updates(since: datetime, model: str = None, limit: int = None) -> list:
+    """[(listing_id, embedding_updated_at), ...] с embedding_updated_at >= since, без самих эмбеддингов."""
+    query = db.session.query(Listing.id, Listing.embedding_updated_at).filter(
+        Listing.embedding_updated_at >= since,
+        Listing.embedding_blob.isnot(None)
+    )
+    if model:
+        query = query.filter(Listing.embedding_model == model)
+    if limit:
+        query = query.limit(limit)
+    return query.all()
+
+
+def poll_embedding_updates(index: LiveIndex, model: str = None, batch_size: int = 500) -> int:
+    """
+    Доливает в index эмбеддинги, которые записали другие процессы (очередь
+    эмбеддингов другого воркера, build_embeddings.py) после index.synced_at.
+    Сначала один индексированный запрос (id, embedding_updated_at) без
+    эмбеддингов; блобы читаются только для строк, которых нет в index.polled,
+    так что окно POLL_OVERLAP не перечитывается каждый раз. None — обновлений
+    больше POLL_LIMIT, индекс нужно пересобрать.
+    """
+    started = datetime.utcnow()
+    since = index.synced_at - POLL_OVERLAP
+    changed = embedding_updates(since, model, POLL_LIMIT + 1)
+    if len(changed) > POLL_LIMIT:
+        return None  # массовый пересчёт (build_embeddings.py) — дешевле пересобрать индекс
+
+    polled = {listing_id: updated_at for listing_id, updated_at in index.polled.items() if updated_at >= since}
+    pending = {listing_id: updated_at for listing_id, updated_at in changed if polled.get(listing_id) != updated_at}
+    ids = list(pending)
+    applied = 0
+    for start in range(0, len(ids), batch_size):
+        rows = db.session.query(
+            Listing.id, Listing.embedding_blob, Listing.embedding_dtype, Listing.embedding_updated_at,
+            Listing.price, Listing.type, Listing.city_key
+        ).filter(Listing.id.in_(ids[start:start + batch_size]), Listing.embedding_blob.isnot(None)).all()
+        for row in rows:
+            polled[row.id] = row.embedding_updated_at
+            vector = np.frombuffer(row.embedding_blob, dtype=EMBEDDING_DTYPES[row.embedding_dtype or "float32"])
+            if index.dim and len(vector) != index.dim:
+                continue
+            index.upsert(row.id, vector, {"price": row.price, "type": row.type, "city_key": row.city_key})
+            applied += 1
+    index.polled = polled
+    index.synced_at = started
+    return applied
+
+
+class IndexReloader:
+    """
+    Фоновый поток listing_index: раз в POLL_INTERVAL секунд доливает чужие
+    эмбеддинги (poll_embedding_updates), раз в max_age секунд или когда
+    обновлений слишком много — пересобирает индекс. Запросы его не ждут.
+    """
+
+    retry_after = 60  # секунд между попытками, если пересборка упала
+
+    def __init__(self, interval: float = POLL_INTERVAL):
+        self.interval = interval
+        self.max_age = 600
+        self._lock = threading.Lock()
+        self._initial = threading.Lock()
+        self._thread = None
+        self._reload = False
+        self._failed_at = None
+
+    def load(self, model: str = None):
+        """
+        Первая загрузка — в текущем потоке: отдавать поиску пока нечего. k-means
+        здесь не обучается: IVF без кластеров из снимка сначала ищет brute-force,
+        а обученный индекс подменяет его фоновой пересборкой.
+        """
+        with self._initial:
+            if listing_index.loaded_at is None:
+                reload_listing_index(model, train=False)
+                if isinstance(make_index(), IVFIndex) and not isinstance(listing_index.base, IVFIndex):
+                    self._reload = True
+
+    def start(self, model: str = None, max_age: int = 600):
+        """Запускает поток (один на процесс); повторные вызовы ничего не делают."""
+        if self._thread is not None:
+            return
+        app = current_app._get_current_object()
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.max_age = max_age
+            self._thread = threading.Thread(
+                target=self._run, args=(app, model), name="listing-index-reload", daemon=True
+            )
+            self._thread.start()
+
+    def _reload_due(self) -> bool:
+        if self._failed_at is not None and time.monotonic() - self._failed_at < self.retry_after:
+            return False
+        return self._reload or time.monotonic() - listing_index.loaded_at >= self.max_age
+
+    def _run(self, app, model):
+        while True:
+            with app.app_context():
+                try:
+                    if self._reload_due():
+                        self._reload = False
+                        reload_listing_index(model)
+                        self._failed_at = None
+                    elif poll_embedding_updates(listing_index, model) is None:
+                        self._reload = True
+                        continue
+                except Exception as e:
+                    db.session.rollback()
+                    self._failed_at = time.monotonic()
+                    app.logger.warning("Listing index update failed: %s: %s", type(e).__name__, e)
+            time.sleep(self.interval)
+
+
+index_reloader = IndexReloader()
+
+
+def ensure_listing_index(model: str = None, max_age: int = 600) -> LiveIndex:
+    """
+    Загружает эмбеддинги объявлений при первом обращении и запускает
+    IndexReloader: индекс пересобирается раз в max_age секунд (эмбеддинги
+    пишет и build_embeddings.py из отдельного процесса) и раз в
+    VECTOR_POLL_INTERVAL секунд доливает чужие записи — всё в фоновом
+    потоке, запросы тем временем ищут по текущему индексу. Свои записи
+    попадают в индекс сразу. Если есть снимок (VECTOR_SNAPSHOT_DIR),
+    база читается только для дельты.
+    """
+    if listing_index.loaded_at is None:
+        index_reloader.load(model)
+    index_reloader.start(model, max_age)
+    return listing_index